@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Benchmarks of the login key derivation, the MegaFS mount and the memory
+of the node table, each against the implementation it replaced.
+
+    python bench.py [login] [mount] [memory] [--max-nodes N]
+"""
+
+from Crypto.Cipher import AES
+from megacrypto import prepare_key, stringhash
+from megautil import a32_to_str, str_to_a32
+import optparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import types
+
+
+def reference_aes_cbc_encrypt_a32(data, key):
+    # one new cipher per block, as before the cipher cache
+    return str_to_a32(AES.new(a32_to_str(key), AES.MODE_CBC, '\0' * 16).encrypt(a32_to_str(data)))
+
+
+def reference_prepare_key(a):
+    pkey = [0x93C467E3, 0x7DB0C7A4, 0xD1BE3F81, 0x0152CB56]
+    for _ in xrange(0x10000):
+        for j in xrange(0, len(a), 4):
+            key = [0, 0, 0, 0]
+            for i in xrange(4):
+                if i + j < len(a):
+                    key[i] = a[i + j]
+            pkey = reference_aes_cbc_encrypt_a32(pkey, key)
+    return tuple(pkey)
+
+
+def reference_stringhash(s, aeskey):
+    s32 = str_to_a32(s)
+    h32 = [0, 0, 0, 0]
+    for i in xrange(len(s32)):
+        h32[i % 4] ^= s32[i]
+    for _ in xrange(0x4000):
+        h32 = reference_aes_cbc_encrypt_a32(h32, aeskey)
+    return h32[0], h32[2]
+
+
+def timed(func, *args):
+    start_time = time.time()
+    result = func(*args)
+    return time.time() - start_time, result
+
+
+def bench_login(options):
+    password = str_to_a32('correct horse battery staple')
+    old_time, old_key = timed(reference_prepare_key, password)
+    new_time, new_key = timed(prepare_key, password)
+    assert tuple(old_key) == tuple(new_key)
+    print 'prepare_key   %7.3f s -> %7.3f s' % (old_time, new_time)
+    old_time, _ = timed(reference_stringhash, 'user@example.com', new_key)
+    new_time, _ = timed(stringhash, 'user@example.com', new_key)
+    print 'stringhash    %7.3f s -> %7.3f s' % (old_time, new_time)
+
+
+def synthetic_nodes(count, keys=False):
+    # one folder per 100 nodes, with names repeating so that paths need deduplication
+    random_a32 = lambda length: tuple(random.getrandbits(32) for _ in xrange(length))
+    folders = max(1, count / 100)
+    yield {'h': u'ROOT', 't': 2, 'p': u'', 'a': {'n': u'Cloud Drive'}, 'ts': 1, 'u': u'me'}
+    for i in xrange(folders):
+        node = {'h': u'd%07d' % (i,), 't': 1, 'p': u'ROOT', 'a': {'n': u'dir%d' % (i % 50,)}, 'ts': 1, 'u': u'me'}
+        if keys:
+            node['k'] = random_a32(4)
+        yield node
+    for i in xrange(count - folders):
+        node = {'h': u'f%07d' % (i,), 't': 0, 'p': u'd%07d' % (i % folders,), 'a': {'n': u'file%d.txt' % (i % 1000,)}, 'ts': 1, 's': 1, 'u': u'me'}
+        if keys:
+            key = random_a32(8)
+            node.update(k=key[:4], iv=key[4:6] + (0, 0), meta_mac=key[6:8])
+        yield node
+
+
+def sizes(options):
+    count = 1000
+    while count <= options.max_nodes:
+        yield count
+        count *= 10
+
+
+def bench_mount(options):
+    try:
+        import fuse
+    except ImportError:
+        # addnode does not need a mount
+        fuse = sys.modules['fuse'] = types.ModuleType('fuse')
+        fuse.Fuse = type('Fuse', (object,), {'__init__': lambda self, *args, **kw: None})
+    from megafs import MegaFS
+    from meganodes import NodeTable
+    for count in sizes(options):
+        fs = MegaFS(None)
+        fs.nodes = NodeTable(synthetic_nodes(count))
+        elapsed, _ = timed(lambda: [fs.addnode(file_h) for file_h in fs.nodes])
+        print 'mount %8d nodes  %7.2f s  %7.2f us/node' % (count, elapsed, elapsed * 1e6 / count)
+
+
+def measure_memory(layout, count):
+    # run in a child process, so that the peak resident size is this layout's alone
+    from meganodes import NodeTable
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if layout == 'dict':
+        files = dict((file['h'], file) for file in synthetic_nodes(count, keys=True))
+    else:
+        files = NodeTable(synthetic_nodes(count, keys=True))
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024
+
+
+def bench_memory(options):
+    for count in sizes(options):
+        used = {}
+        for layout in ('dict', 'table'):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--measure-memory', layout, str(count)])
+            used[layout] = int(output)
+        print 'memory %7d nodes  dicts %6d MiB  node table %6d MiB' % (count, used['dict'], used['table'])
+
+
+BENCHMARKS = [('login', bench_login), ('mount', bench_mount), ('memory', bench_memory)]
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [' + '|'.join(name for name, _ in BENCHMARKS) + ']...')
+    parser.add_option('--max-nodes', type='int', default=100000, help='largest synthetic tree, from 1000 by factors of 10 [default: %default]')
+    parser.add_option('--measure-memory', nargs=2, help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    if options.measure_memory:
+        layout, count = options.measure_memory
+        print measure_memory(layout, int(count))
+        return
+    for name, benchmark in BENCHMARKS:
+        if not args or name in args:
+            benchmark(options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Times mega.py startup per command and fails when one is over its budget.
+
+Without --home the commands run against an empty configuration: find then
+stops at "You must login first", after loading everything up to the tree.
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# command line, budget in milliseconds
+COMMANDS = [
+    (['help'], 150),
+    (['find'], 250),
+    (['daemon', 'status'], 150),
+    ]
+
+
+def timecommand(args, env, runs):
+    mega = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mega.py')
+    times = []
+    with open(os.devnull, 'wb') as null:
+        for _ in xrange(runs):
+            start_time = time.time()
+            subprocess.call([sys.executable, mega] + args, stdout=null, stderr=null, env=env)
+            times.append(time.time() - start_time)
+    # the median: one slow run on a busy machine should not fail the budget
+    return sorted(times)[len(times) / 2] * 1000
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--runs', type='int', default=10, help='runs per command [default: %default]')
+    parser.add_option('--home', help='HOME holding a logged in configuration [default: an empty one]')
+    parser.add_option('--scale', type='float', default=1., help='multiply every budget, for slow machines [default: %default]')
+    options, args = parser.parse_args()
+
+    home = options.home or tempfile.mkdtemp(prefix='megabench')
+    env = dict(os.environ, HOME=home)
+    over = 0
+    try:
+        for args, budget in COMMANDS:
+            elapsed = timecommand(args, env, options.runs)
+            budget *= options.scale
+            status = 'ok' if elapsed <= budget else 'OVER BUDGET'
+            if elapsed > budget:
+                over += 1
+            print '%-16s %6d ms  (budget %d ms)  %s' % (' '.join(args), elapsed, budget, status)
+    finally:
+        if not options.home:
+            shutil.rmtree(home)
+    return 1 if over else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,5 @@
 #!/usr/bin/env python
 
-import time
-import json
-import yaml
-# import pyaml
-
 from cltools.runnable import CLRunnable
 
 class CLRunner(object) :
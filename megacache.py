@@ -0,0 +1,125 @@
+from collections import OrderedDict
+import os
+import threading
+
+
+class BlockCache(object):
+    """LRU cache of decrypted file blocks, kept in memory and spilled to an
+    optional directory shared between processes. The spilled blocks are
+    plaintext, in owner-only files of an owner-only directory."""
+
+    def __init__(self, cache_dir=None, memory_size=64 << 20, disk_size=1 << 30, block_size=0x20000):
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.block_size = block_size
+        self.blocks = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = 0
+        self.lock = threading.Lock()
+        if self.cache_dir:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir, mode=0700)
+            self.disk_used = sum(size for _, size, _ in self.diskentries())
+
+    def key(self, file, index):
+        # a modified node gets a new timestamp and size, so stale blocks never match
+        return '%s.%d-%d.%d' % (file.h, file.ts, file.s, index)
+
+    def get(self, file, index):
+        key = self.key(file, index)
+        with self.lock:
+            if key in self.blocks:
+                data = self.blocks.pop(key)
+                self.blocks[key] = data
+                return data
+        if self.cache_dir:
+            filename = os.path.join(self.cache_dir, key)
+            try:
+                with open(filename, 'rb') as handle:
+                    data = handle.read()
+                os.utime(filename, None)
+            except (IOError, OSError):
+                return None
+            self.putmemory(key, data)
+            return data
+        return None
+
+    def put(self, file, index, data):
+        self.putmemory(self.key(file, index), data)
+
+    def putmemory(self, key, data):
+        spilled = []
+        with self.lock:
+            if key in self.blocks:
+                self.memory_used -= len(self.blocks.pop(key))
+            self.blocks[key] = data
+            self.memory_used += len(data)
+            while self.memory_used > self.memory_size and len(self.blocks) > 1:
+                old_key, old_data = self.blocks.popitem(last=False)
+                self.memory_used -= len(old_data)
+                spilled.append((old_key, old_data))
+        for old_key, old_data in spilled:
+            self.spill(old_key, old_data)
+
+    def spill(self, key, data):
+        if not self.cache_dir or len(data) > self.disk_size:
+            return
+        filename = os.path.join(self.cache_dir, key)
+        if os.path.exists(filename):
+            return
+        tmp_filename = '%s.tmp-%d-%d' % (filename, os.getpid(), threading.current_thread().ident)
+        try:
+            # the blocks are decrypted file data: only readable by the owner
+            with os.fdopen(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb') as handle:
+                handle.write(data)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            return
+        with self.lock:
+            self.disk_used += len(data)
+            if self.disk_used <= self.disk_size:
+                return
+        self.evictdisk()
+
+    def diskentries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            filename = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+        return entries
+
+    def evictdisk(self):
+        # other processes may share the directory: recount before evicting
+        entries = sorted(self.diskentries())
+        used = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if used <= self.disk_size:
+                break
+            try:
+                os.unlink(filename)
+                used -= size
+            except OSError:
+                pass
+        with self.lock:
+            self.disk_used = used
+
+    def invalidate(self, handles):
+        # only frees memory: blocks of a changed node no longer match its key, and the stale
+        # ones on disk are evicted as the least recently used without scanning the directory
+        prefixes = tuple(handle + '.' for handle in handles)
+        if not prefixes:
+            return
+        with self.lock:
+            for key in [key for key in self.blocks if key.startswith(prefixes)]:
+                self.memory_used -= len(self.blocks.pop(key))
+
+    def flush(self):
+        with self.lock:
+            blocks = self.blocks.items()
+        for key, data in blocks:
+            self.spill(key, data)
@@ -1,29 +1,314 @@
-from Crypto.Cipher import AES
-from Crypto.Util import Counter
-from Crypto.PublicKey import RSA
-from megacrypto import prepare_key, stringhash, encrypt_key, decrypt_key, enc_attr, dec_attr, aes_cbc_encrypt_a32
-from megautil import a32_to_str, str_to_a32, a32_to_base64, base64_to_a32, mpi2int, base64urlencode, base64urldecode, get_chunks
+from megacrypto import prepare_key, stringhash, encrypt_key, decrypt_key, enc_attr, dec_attr, aes_ctr_cipher, chunk_mac, condense_macs
+from megahttp import HTTPTransport
+from meganodes import NodeTable
+from megaretry import EAGAIN, RequestMetrics, RetryPolicy
+from megautil import a32_to_str, str_to_a32, a32_to_base64, base64_to_a32, mpi2int, base64urlencode, base64urldecode, get_chunks, parallel_map
 import binascii
+import collections
+import httplib
+import itertools
 import json
 import os
 import random
-import urllib
+import threading
+import time
+
+
+def decrypt_nodes(batch):
+    # Module level so that it can run in a process pool: decrypts the keys and attributes of nodes sharing one decrypting key
+    key, nodes = batch
+    node_keys = decrypt_key(tuple(itertools.chain.from_iterable(enc_key for t, enc_key, attributes in nodes)), key)
+    results = []
+    p = 0
+    for t, enc_key, attributes in nodes:
+        node_key = node_keys[p:p + len(enc_key)]
+        p += len(enc_key)
+        decrypted = {}
+        if t == 0:
+            k = decrypted['k'] = (node_key[0] ^ node_key[4], node_key[1] ^ node_key[5], node_key[2] ^ node_key[6], node_key[3] ^ node_key[7])
+            decrypted['iv'] = node_key[4:6] + (0, 0)
+            decrypted['meta_mac'] = node_key[6:8]
+        else:
+            k = decrypted['k'] = node_key
+        decrypted['a'] = dec_attr(base64urldecode(attributes), k)
+        results.append(decrypted)
+    return results
+
+
+class MegaError(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, 'Mega API error %d' % (code,))
+        self.code = code
+
+
+class APIResult(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class DownloadStream(object):
+    """Decrypting file-like reader of a remote file: the next chunks are
+    fetched in parallel, at most `connections` of them held in memory, and
+    the MAC is checked when the end is reached."""
+
+    def __init__(self, client, file, connections):
+        self.client = client
+        self.file = file
+        self.connections = connections
+        self.dl_url = client.getdownloadurl(file)
+        self.chunks = collections.deque(sorted(get_chunks(file.s).items()))
+        self.pending = collections.deque()
+        self.macs = []
+        self.buffer = ''
+        self.position = 0
+        self.closed = False
+
+    def fetch(self, chunk_start, chunk_size, result):
+        try:
+            result.value = self.client.downloadchunk(self.file, self.dl_url, chunk_start, chunk_size)
+        except Exception, e:
+            result.error = e
+        result.done.set()
+
+    def fill(self):
+        while self.chunks and len(self.pending) < self.connections:
+            chunk_start, chunk_size = self.chunks.popleft()
+            result = APIResult()
+            thread = threading.Thread(target=self.fetch, args=(chunk_start, chunk_size, result))
+            thread.daemon = True
+            thread.start()
+            self.pending.append(result)
+
+    def nextchunk(self):
+        self.fill()
+        if not self.pending:
+            if self.macs is not None:
+                if condense_macs(self.macs, self.file.k) != self.file.meta_mac:
+                    raise IOError('MAC mismatch on %s' % (self.file.h,))
+                self.macs = None
+            return False
+        self.buffer = self.pending.popleft().get()
+        self.position = 0
+        self.macs.append(chunk_mac(self.buffer, self.file.k, self.file.iv))
+        self.fill()
+        return True
+
+    def read(self, size=-1):
+        data = []
+        while size != 0:
+            if self.position == len(self.buffer) and not self.nextchunk():
+                break
+            available = len(self.buffer) - self.position
+            length = available if size < 0 else min(size, available)
+            # a whole chunk is handed over without a copy
+            data.append(self.buffer if length == len(self.buffer) else self.buffer[self.position:self.position + length])
+            self.position += length
+            if size > 0:
+                size -= length
+        return ''.join(data) if len(data) != 1 else data[0]
+
+    def close(self):
+        # chunks still in flight are dropped
+        self.closed = True
+        self.pending.clear()
+        self.chunks.clear()
+        self.buffer = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class UploadStream(object):
+    """Encrypting file-like writer of a new remote file of a known size:
+    every complete chunk is sent while the next one is written, at most
+    `connections` chunks in flight; close creates the node."""
+
+    def __init__(self, client, target, filename, size, connections):
+        self.client = client
+        self.target = target
+        self.filename = filename
+        self.size = size
+        res = client.api_req({'a': 'u', 's': size})
+        if isinstance(res, int):
+            raise MegaError(res)
+        self.ul_url = res['p']
+        self.ul_key = [random.randint(0, 0xFFFFFFFF) for _ in xrange(6)]
+        self.chunks = collections.deque(sorted(get_chunks(size).items()))
+        self.slots = threading.BoundedSemaphore(connections)
+        self.results = []
+        self.buffer = []
+        self.buffered = 0
+        self.closed = False
+        self.result = None
+
+    def post(self, chunk_start, chunk, result):
+        try:
+            if self.client.limiter is not None:
+                self.client.limiter.consume(len(chunk))
+            result.value = self.client.retry.call('upload', self.client.uploadrange, self.ul_url, chunk_start, chunk)
+        except Exception, e:
+            result.error = e
+        finally:
+            self.slots.release()
+        result.done.set()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.chunks and self.buffered >= self.chunks[0][1]:
+            # joined once per write, then every complete chunk is a slice of it
+            data = ''.join(self.buffer)
+            offset = 0
+            while self.chunks and len(data) - offset >= self.chunks[0][1]:
+                chunk_start, chunk_size = self.chunks.popleft()
+                self.sendchunk(chunk_start, data[offset:offset + chunk_size])
+                offset += chunk_size
+            self.buffer = [data[offset:]] if offset < len(data) else []
+            self.buffered = len(data) - offset
+        if self.buffered and not self.chunks:
+            raise IOError('More than the %d bytes announced for %s' % (self.size, self.filename))
+
+    def sendchunk(self, chunk_start, chunk):
+        mac = chunk_mac(chunk, self.ul_key[:4], self.ul_key[4:6])
+        chunk = aes_ctr_cipher(self.ul_key[:4], self.ul_key[4:6], chunk_start).encrypt(chunk)
+        # blocks the writer while all the connections are busy
+        self.slots.acquire()
+        result = APIResult()
+        thread = threading.Thread(target=self.post, args=(chunk_start, chunk, result))
+        thread.daemon = True
+        thread.start()
+        self.results.append((mac, result))
+
+    def close(self):
+        if self.closed:
+            return self.result
+        self.closed = True
+        if self.chunks:
+            raise IOError('Only %d of the %d bytes announced for %s were written' % (self.chunks[0][0] + self.buffered, self.size, self.filename))
+        self.result = self.client.completeupload(self.target, self.filename, self.ul_key, [(mac, result.get()) for mac, result in self.results])
+        if isinstance(self.result, int) and self.result < 0:
+            raise MegaError(self.result)
+        return self.result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # an upload interrupted by an error is left incomplete
+        if exc_type is None:
+            self.close()
 
 
 class MegaClient:
-    def __init__(self, email, password):
+    def __init__(self, email, password, transport=None):
         self.seqno = random.randint(0, 0xFFFFFFFF)
         self.sid = ''
         self.email = email
         self.password = password
+        self.download_connections = 4
+        self.upload_connections = 4
+        self.decrypt_processes = 0
+        self.api_url = 'https://g.api.mega.co.nz/'
+        self.sn = None
+        self.users_keys = {}
+        self.lock = threading.Lock()
+        self.transport = transport if transport is not None else HTTPTransport()
+        self.poll_timeout = 600
+        self.upload_url_ttl = 12 * 3600
+        # optional megautil.RateLimiter shared by all the transfer chunks
+        self.limiter = None
+        self.batch = []
+        self.batch_lock = threading.Lock()
+        self.batch_window = 0.01
+        self.batch_size = 50
+        self.metrics = RequestMetrics()
+        self.retry = RetryPolicy(self.metrics)
 
     def api_req(self, req):
-        url = 'https://g.api.mega.co.nz/cs?id=%d%s' % (self.seqno, '&sid=%s' % self.sid if self.sid else '')
-        self.seqno += 1
-        return json.loads(self.post(url, json.dumps([req])))[0]
+        return self.api_batch([req])[0]
+
+    def api_batch(self, reqs):
+        # the cs endpoint takes a list of commands and answers with the list of their results;
+        # commands answered with EAGAIN are sent again on their own after a backoff
+        results = [None] * len(reqs)
+        pending = range(len(reqs))
+        attempt = 0
+        while True:
+            with self.lock:
+                seqno = self.seqno
+                self.seqno += 1
+            # the retries of a failed request keep its sequence number, so the server never runs it twice
+            url = '%scs?id=%d%s' % (self.api_url, seqno, '&sid=%s' % self.sid if self.sid else '')
+            start_time = time.time()
+            res = self.retry.call('cs', self.api_post, url, [reqs[i] for i in pending])
+            elapsed = time.time() - start_time
+            for i, result in zip(pending, res):
+                results[i] = result
+                self.metrics.record(reqs[i].get('a'), elapsed, result if isinstance(result, int) and result < 0 else None)
+            pending = [i for i in pending if results[i] == EAGAIN]
+            if not pending or not self.retry.backoff('cs', attempt):
+                return results
+            for i in pending:
+                self.metrics.retry(reqs[i].get('a'))
+            attempt += 1
+
+    def api_post(self, url, reqs):
+        res = json.loads(self.post(url, json.dumps(reqs)))
+        if isinstance(res, int):
+            # the whole request failed
+            if res == EAGAIN:
+                raise MegaError(res)
+            return [res] * len(reqs)
+        return res
+
+    def api_submit(self, req):
+        # Queue a command for the next batch, sent when the batch window closes or the batch is full
+        result = APIResult()
+        with self.batch_lock:
+            self.batch.append((req, result))
+            if len(self.batch) >= self.batch_size:
+                flush = True
+            else:
+                flush = False
+                if len(self.batch) == 1:
+                    timer = threading.Timer(self.batch_window, self.api_flush)
+                    timer.daemon = True
+                    timer.start()
+        if flush:
+            self.api_flush()
+        return result
+
+    def api_flush(self):
+        with self.batch_lock:
+            batch, self.batch = self.batch, []
+        if not batch:
+            return
+        try:
+            responses = self.api_batch([req for req, result in batch])
+        except Exception, e:
+            responses = [e] * len(batch)
+        for (req, result), response in zip(batch, responses):
+            if isinstance(response, Exception):
+                result.error = response
+            elif isinstance(response, int) and response < 0:
+                result.error = MegaError(response)
+            else:
+                result.value = response
+            result.done.set()
 
     def post(self, url, data):
-        return urllib.urlopen(url, data).read()
+        return self.transport.request('POST', url, data)
 
     def login(self):
         password_aes = prepare_key(str_to_a32(self.password))
@@ -50,54 +335,86 @@ class MegaClient:
                 privk = privk[l:]
 
             enc_sid = mpi2int(base64urldecode(res['csid']))
+            # only needed for this kind of session, and slow to import
+            from Crypto.PublicKey import RSA
             decrypter = RSA.construct((self.rsa_priv_key[0] * self.rsa_priv_key[1], 0L, self.rsa_priv_key[2], self.rsa_priv_key[0], self.rsa_priv_key[1]))
             sid = '%x' % decrypter.key._decrypt(enc_sid)
             sid = binascii.unhexlify('0' + sid if len(sid) % 2 else sid)
             self.sid = base64urlencode(sid[:43])
 
-    def processfile(self, file, users_keys):
-        if file['t'] == 0 or file['t'] == 1:
-            keys = dict(keypart.split(':',1) for keypart in file['k'].split('/'))
-            uid = file['u']
-            key = None
-            if uid in keys :
-                # normal file or folder
-                key = decrypt_key(base64_to_a32( keys[uid] ), self.master_key)
-            elif 'su' in file and 'sk' in file and ':' in file['k']:
-                # Shared folder
-                user_key = decrypt_key(base64_to_a32(file['sk']),self.master_key)
-                key = decrypt_key(base64_to_a32(keys[file['h']]),user_key)
-                if file['su'] not in users_keys :
-                    users_keys[file['su']] = {}
-                users_keys[file['su']][file['h']] = user_key
-            elif file['u'] and file['u'] in users_keys :
-                # Shared file
-                for hkey in users_keys[file['u']] :
-                    user_key = users_keys[file['u']][hkey]
-                    if hkey in keys :
-                        key = keys[hkey]
-                        key = decrypt_key(base64_to_a32(key),user_key)
-                        break
-            if key is not None :
-                if file['t'] == 0:
-                    k = file['k'] = (key[0] ^ key[4], key[1] ^ key[5], key[2] ^ key[6], key[3] ^ key[7])
-                    iv = file['iv'] = key[4:6] + (0, 0)
-                    meta_mac = file['meta_mac'] = key[6:8]
-                else:
-                    k = file['k'] = key
-                attributes = base64urldecode(file['a'])
-                attributes = dec_attr(attributes, k)
-                file['a'] = attributes
-        elif file['t'] == 2:
-            self.root_id = file['h']
-            file['a'] = {'n': 'Cloud Drive'}
-        elif file['t'] == 3:
-            self.inbox_id = file['h']
-            file['a'] = {'n': 'Inbox'}
-        elif file['t'] == 4:
-            self.trashbin_id = file['h']
-            file['a'] = {'n': 'Rubbish Bin'}
-        return file
+    def nodekey(self, file, users_keys):
+        # returns (decrypting key, encrypted node key)
+        keys = dict(keypart.split(':',1) for keypart in file['k'].split('/'))
+        uid = file['u']
+        if uid in keys :
+            # normal file or folder
+            return self.master_key, base64_to_a32(keys[uid])
+        elif 'su' in file and 'sk' in file and ':' in file['k']:
+            # Shared folder
+            return users_keys[file['su']][file['h']], base64_to_a32(keys[file['h']])
+        elif file['u'] and file['u'] in users_keys :
+            # Shared file
+            for hkey in users_keys[file['u']] :
+                if hkey in keys :
+                    return users_keys[file['u']][hkey], base64_to_a32(keys[hkey])
+        return None, None
+
+    def init_sharekeys(self, files, users_keys):
+        # Shared folders carry their share key, encrypted with the master key
+        shared = [file for file in files if file['t'] == 1 and 'su' in file and 'sk' in file]
+        if not shared:
+            return
+        share_keys = decrypt_key(tuple(itertools.chain.from_iterable(base64_to_a32(file['sk']) for file in shared)), self.master_key)
+        for i, file in enumerate(shared):
+            if file['su'] not in users_keys :
+                users_keys[file['su']] = {}
+            users_keys[file['su']][file['h']] = share_keys[i * 4:i * 4 + 4]
+
+    def processfiles(self, files, users_keys, processes=None):
+        # Group the nodes by the key protecting their own key, so each group is decrypted with one cipher
+        groups = {}
+        for file in files:
+            if file['t'] == 0 or file['t'] == 1:
+                key, enc_key = self.nodekey(file, users_keys)
+                if key is not None:
+                    groups.setdefault(tuple(key), []).append((file, enc_key))
+        batches = []
+        for key, group in groups.items():
+            for i in xrange(0, len(group), 1000):
+                nodes = group[i:i + 1000]
+                batches.append(([file for file, enc_key in nodes], (key, [(file['t'], enc_key, file['a']) for file, enc_key in nodes])))
+
+        if processes:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(decrypt_nodes, [batch for group, batch in batches])
+            finally:
+                pool.close()
+        else:
+            results = [decrypt_nodes(batch) for group, batch in batches]
+
+        for (group, batch), result in zip(batches, results):
+            for file, decrypted in zip(group, result):
+                file.update(decrypted)
+
+        for file in files:
+            if file['t'] == 2:
+                self.root_id = file['h']
+                file['a'] = {'n': 'Cloud Drive'}
+            elif file['t'] == 3:
+                self.inbox_id = file['h']
+                file['a'] = {'n': 'Inbox'}
+            elif file['t'] == 4:
+                self.trashbin_id = file['h']
+                file['a'] = {'n': 'Rubbish Bin'}
+        return files
+
+    def processfile(self, file, users_keys=None):
+        if users_keys is None:
+            users_keys = {}
+        self.init_sharekeys([file], users_keys)
+        return self.processfiles([file], users_keys)[0]
 
     def init_sharedkeys(self,files,users_keys) :
         # Init shared keys that comes from shared folders that aren't shared anymore
@@ -111,79 +428,249 @@ class MegaClient:
             if s_item['h'] in ok_dict :
                 users_keys[s_item['u']][s_item['h']] = ok_dict[s_item['h']]
 
-    def getfiles(self):
+    def getfiles(self, processes=None):
         files = self.api_req({'a': 'f', 'c': 1})
-        files_dict = {}
+        if processes is None:
+            processes = self.decrypt_processes
         users_keys={}
         self.init_sharedkeys(files,users_keys)
-        for file in files['f']:
-            files_dict[file['h']] = self.processfile(file,users_keys)
-        return files_dict
-
-    def downloadfile(self, file, dest_path):
-        dl_url = self.api_req({'a': 'g', 'g': 1, 'n': file['h']})['g']
-
-        infile = urllib.urlopen(dl_url)
-        outfile = open(dest_path, 'wb')
-        decryptor = AES.new(a32_to_str(file['k']), AES.MODE_CTR, counter = Counter.new(128, initial_value = ((file['iv'][0] << 32) + file['iv'][1]) << 64))
-
-        file_mac = [0, 0, 0, 0]
-        for chunk_start, chunk_size in sorted(get_chunks(file['s']).items()):
-            chunk = infile.read(chunk_size)
-            chunk = decryptor.decrypt(chunk)
-            outfile.write(chunk)
-
-            chunk_mac = [file['iv'][0], file['iv'][1], file['iv'][0], file['iv'][1]]
-            for i in xrange(0, len(chunk), 16):
-                block = chunk[i:i+16]
-                if len(block) % 16:
-                    block += '\0' * (16 - (len(block) % 16))
-                block = str_to_a32(block)
-                chunk_mac = [chunk_mac[0] ^ block[0], chunk_mac[1] ^ block[1], chunk_mac[2] ^ block[2], chunk_mac[3] ^ block[3]]
-                chunk_mac = aes_cbc_encrypt_a32(chunk_mac, file['k'])
-
-            file_mac = [file_mac[0] ^ chunk_mac[0], file_mac[1] ^ chunk_mac[1], file_mac[2] ^ chunk_mac[2], file_mac[3] ^ chunk_mac[3]]
-            file_mac = aes_cbc_encrypt_a32(file_mac, file['k'])
-
-        outfile.close()
-        infile.close()
-
-        return (file_mac[0] ^ file_mac[1], file_mac[2] ^ file_mac[3]) == file['meta_mac']
-
-    def uploadfile(self, src_path, target, filename):
-        infile = open(src_path, 'rb')
-        size = os.path.getsize(src_path)
-        ul_url = self.api_req({'a': 'u', 's': size})['p']
+        self.init_sharekeys(files['f'],users_keys)
+        table = NodeTable(self.processfiles(files['f'], users_keys, processes))
+        self.sn = files.get('sn')
+        self.users_keys = users_keys
+        return table
+
+    def getupdates(self, sn):
+        # Fetch the pending action packets since sn: returns (packets, sn, wait url), or Nones when sn is too old to catch up
+        packets = []
+        while True:
+            res = self.retry.call('sc', self.sc_post, sn)
+            if isinstance(res, int):
+                return None, None, None
+            if 'a' in res:
+                packets.extend(res['a'])
+            if 'sn' in res:
+                sn = res['sn']
+            if 'w' in res or not res.get('a'):
+                return packets, sn, res.get('w')
+
+    def sc_post(self, sn):
+        res = json.loads(self.post('%ssc?sn=%s&sid=%s' % (self.api_url, sn, self.sid), ''))
+        if res == EAGAIN:
+            raise MegaError(res)
+        return res
+
+    def pollupdates(self, sn):
+        # Block on the server wait url until action packets arrive
+        while True:
+            packets, sn, wait_url = self.getupdates(sn)
+            if packets or packets is None or wait_url is None:
+                return packets, sn
+            self.transport.request('GET', wait_url, timeout=self.poll_timeout)
+
+    def applypackets(self, files, packets):
+        # Apply action packets to files; returns the (action, handle) changes, action in 'add', 'update', 'delete'
+        changes = []
+        # children by parent handle, built on the first delete and kept up to date after; entries may be stale
+        children = None
+        for packet in packets:
+            action = packet.get('a')
+            if action == 't':
+                # processfiles decrypts in place: keep the packet as received, so that it can be applied again
+                nodes = [dict(node) for node in packet['t']['f']]
+                self.init_sharekeys(nodes, self.users_keys)
+                for file in self.processfiles(nodes, self.users_keys):
+                    changes.append(('update' if file['h'] in files else 'add', file['h']))
+                    node = files.add(file)
+                    if children is not None:
+                        children.setdefault(files.parenthandle(node), []).append(node.h)
+            elif action == 'u' and packet.get('n') in files:
+                node = files[packet['n']]
+                if 'at' in packet and node.key:
+                    attributes = dec_attr(base64urldecode(packet['at']), node.k)
+                    if attributes and 'n' in attributes:
+                        node.name = files.intern(attributes['n'])
+                if 'ts' in packet:
+                    node.ts = packet['ts']
+                changes.append(('update', node.h))
+            elif action == 'd' and packet.get('n') in files and not packet.get('m'):
+                # moves are sent as a flagged delete followed by the node itself; otherwise only the root of a deleted subtree is sent
+                if children is None:
+                    children = {}
+                    for node in files.values():
+                        children.setdefault(files.parenthandle(node), []).append(node.h)
+                deleted = [packet['n']]
+                seen = set(deleted)
+                for handle in deleted:
+                    for child in children.pop(handle, []):
+                        if child not in seen and child in files and files.parenthandle(files[child]) == handle:
+                            seen.add(child)
+                            deleted.append(child)
+                for handle in reversed(deleted):
+                    files.remove(handle)
+                    changes.append(('delete', handle))
+        return changes
+
+    def loadfiles(self, store):
+        # Start from the stored snapshot and only fetch what changed since, falling back to a full getfiles
+        snapshot = store.load(self.master_key)
+        files = None
+        if snapshot is not None:
+            packets, sn, wait_url = self.getupdates(snapshot['sn'])
+            if packets is not None:
+                files = NodeTable.fromrows(snapshot['nodes'])
+                self.users_keys = snapshot['users_keys']
+                self.applypackets(files, packets)
+                self.sn = sn
+        if files is None:
+            files = self.getfiles()
+        self.savefiles(store, files)
+        return files
+
+    def savefiles(self, store, files):
+        store.save(self.master_key, {'sn': self.sn, 'nodes': files.export(), 'users_keys': self.users_keys})
 
-        ul_key = [random.randint(0, 0xFFFFFFFF) for _ in xrange(6)]
-        encryptor = AES.new(a32_to_str(ul_key[:4]), AES.MODE_CTR, counter = Counter.new(128, initial_value = ((ul_key[4] << 32) + ul_key[5]) << 64))
+    def getdownloadurl(self, file):
+        return self.api_submit({'a': 'g', 'g': 1, 'n': file.h}).get()['g']
 
-        file_mac = [0, 0, 0, 0]
-        for chunk_start, chunk_size in sorted(get_chunks(size).items()):
-            chunk = infile.read(chunk_size)
+    def downloadrange(self, file, dl_url, offset, size):
+        end = min(offset + size, file.s)
+        if offset >= end:
+            return ''
+        # CTR can only be positioned on a 16 bytes boundary
+        start = offset - offset % 16
+        data = self.transport.request('GET', dl_url, headers={'Range': 'bytes=%d-%d' % (start, end - 1)})
+        decryptor = aes_ctr_cipher(file.k, file.iv, start)
+        return decryptor.decrypt(data)[offset - start:]
 
-            chunk_mac = [ul_key[4], ul_key[5], ul_key[4], ul_key[5]]
-            for i in xrange(0, len(chunk), 16):
-                block = chunk[i:i+16]
-                if len(block) % 16:
-                    block += '\0' * (16 - len(block) % 16)
-                block = str_to_a32(block)
-                chunk_mac = [chunk_mac[0] ^ block[0], chunk_mac[1] ^ block[1], chunk_mac[2] ^ block[2], chunk_mac[3] ^ block[3]]
-                chunk_mac = aes_cbc_encrypt_a32(chunk_mac, ul_key[:4])
+    def fetchchunk(self, file, dl_url, chunk_start, chunk_size):
+        chunk = self.downloadrange(file, dl_url, chunk_start, chunk_size)
+        if len(chunk) != chunk_size:
+            raise httplib.IncompleteRead(chunk, chunk_size - len(chunk))
+        return chunk
 
-            file_mac = [file_mac[0] ^ chunk_mac[0], file_mac[1] ^ chunk_mac[1], file_mac[2] ^ chunk_mac[2], file_mac[3] ^ chunk_mac[3]]
-            file_mac = aes_cbc_encrypt_a32(file_mac, ul_key[:4])
+    def downloadchunk(self, file, dl_url, chunk_start, chunk_size):
+        # a failed chunk is fetched again on its own, the others are kept
+        if self.limiter is not None:
+            self.limiter.consume(chunk_size)
+        return self.retry.call('download', self.fetchchunk, file, dl_url, chunk_start, chunk_size)
 
-            chunk = encryptor.encrypt(chunk)
-            outfile = urllib.urlopen(ul_url + "/" + str(chunk_start), chunk)
-            completion_handle = outfile.read()
-            outfile.close()
+    def downloadfile(self, file, dest_path, connections=None, journal=None):
+        dl_url = self.getdownloadurl(file)
+        if connections is None:
+            connections = self.download_connections
 
-        infile.close()
+        done = {}
+        if journal is not None:
+            identity = {'h': file.h, 'ts': file.ts, 's': file.s}
+            done = journal.resume(identity)
+            if done and not (os.path.exists(dest_path) and os.path.getsize(dest_path) == file.s):
+                journal.reset(identity)
+                done = {}
+        if not done:
+            with open(dest_path, 'wb') as outfile:
+                outfile.truncate(file.s)
 
-        meta_mac = (file_mac[0] ^ file_mac[1], file_mac[2] ^ file_mac[3])
+        def downloadchunk(chunk_item):
+            chunk_start, chunk_size = chunk_item
+            chunk = self.downloadchunk(file, dl_url, chunk_start, chunk_size)
+            # no os.pwrite in python 2: every chunk writes through its own handle
+            with open(dest_path, 'r+b') as outfile:
+                outfile.seek(chunk_start)
+                outfile.write(chunk)
+            mac = chunk_mac(chunk, file.k, file.iv)
+            if journal is not None:
+                journal.record(chunk_start, mac)
+            return mac
+
+        chunks = sorted(get_chunks(file.s).items())
+        macs = dict((chunk_start, tuple(mac)) for chunk_start, mac in done.items())
+        missing = [chunk_item for chunk_item in chunks if chunk_item[0] not in macs]
+        macs.update(zip([chunk_start for chunk_start, chunk_size in missing], parallel_map(downloadchunk, missing, connections)))
+
+        valid = condense_macs([macs[chunk_start] for chunk_start, chunk_size in chunks], file.k) == file.meta_mac
+        if journal is not None:
+            # a corrupted download must not be resumed
+            journal.delete()
+        return valid
+
+    def uploadrange(self, ul_url, offset, data):
+        response = self.transport.request('POST', '%s/%d' % (ul_url, offset), data)
+        # a failed chunk is answered with a negative error code instead of an empty body or the completion handle
+        if response.startswith('-') and response[1:].isdigit():
+            raise MegaError(int(response))
+        return response
+
+    def completeupload(self, target, filename, ul_key, results):
+        # results are the (mac, response) of every chunk, in file order
+        # the completion handle comes back on whichever chunk completes the upload
+        completion_handle = ''.join(response for mac, response in results)
+        meta_mac = condense_macs([mac for mac, response in results], ul_key[:4])
 
         attributes = {'n': filename}
         enc_attributes = enc_attr(attributes, ul_key[:4])
         key = [ul_key[0] ^ ul_key[4], ul_key[1] ^ ul_key[5], ul_key[2] ^ meta_mac[0], ul_key[3] ^ meta_mac[1], ul_key[4], ul_key[5], meta_mac[0], meta_mac[1]]
         return self.api_req({'a': 'p', 't': target, 'n': [{'h': completion_handle, 't': 0, 'a': base64urlencode(enc_attributes), 'k': a32_to_base64(encrypt_key(key, self.master_key))}]})
+
+    def uploadfile(self, src_path, target, filename, connections=None, journal=None):
+        size = os.path.getsize(src_path)
+        if connections is None:
+            connections = self.upload_connections
+
+        done = {}
+        if journal is not None:
+            # the upload url expires: an older journal starts over
+            done = journal.resume({'src': os.path.abspath(src_path), 's': size, 'mtime': os.path.getmtime(src_path), 'target': target}, self.upload_url_ttl)
+        if journal is not None and 'ul_url' in journal.fields:
+            ul_url = journal.fields['ul_url']
+            ul_key = journal.fields['ul_key']
+        else:
+            ul_url = self.api_req({'a': 'u', 's': size})['p']
+            ul_key = [random.randint(0, 0xFFFFFFFF) for _ in xrange(6)]
+            if journal is not None:
+                journal.setfields(ul_url=ul_url, ul_key=ul_key)
+
+        def uploadchunk(chunk_item):
+            chunk_start, chunk_size = chunk_item
+            with open(src_path, 'rb') as infile:
+                infile.seek(chunk_start)
+                chunk = infile.read(chunk_size)
+            mac = chunk_mac(chunk, ul_key[:4], ul_key[4:6])
+            chunk = aes_ctr_cipher(ul_key[:4], ul_key[4:6], chunk_start).encrypt(chunk)
+            if self.limiter is not None:
+                self.limiter.consume(chunk_size)
+            response = self.retry.call('upload', self.uploadrange, ul_url, chunk_start, chunk)
+            if journal is not None:
+                journal.record(chunk_start, (mac, response))
+            return mac, response
+
+        chunks = sorted(get_chunks(size).items())
+        results = dict((chunk_start, (tuple(mac), response)) for chunk_start, (mac, response) in done.items())
+        missing = [chunk_item for chunk_item in chunks if chunk_item[0] not in results]
+        try:
+            results.update(zip([chunk_start for chunk_start, chunk_size in missing], parallel_map(uploadchunk, missing, connections)))
+        except Exception, e:
+            if done and not self.retry.transient(e):
+                # the resumed upload url was refused: the next attempt starts over
+                journal.delete()
+            raise
+        results = [results[chunk_start] for chunk_start, chunk_size in chunks]
+
+        res = self.completeupload(target, filename, ul_key, results)
+        if journal is not None and not (isinstance(res, int) and res < 0):
+            journal.delete()
+        return res
+
+    def createfolder(self, target, name):
+        key = [random.randint(0, 0xFFFFFFFF) for _ in xrange(4)]
+        enc_attributes = enc_attr({'n': name}, key)
+        return self.api_req({'a': 'p', 't': target, 'n': [{'h': 'xxxxxxxx', 't': 1, 'a': base64urlencode(enc_attributes), 'k': a32_to_base64(encrypt_key(key, self.master_key))}]})
+
+    def deletenode(self, handle):
+        return self.api_req({'a': 'd', 'n': handle})
+
+    def openfile(self, file, connections=None):
+        return DownloadStream(self, file, connections or self.download_connections)
+
+    def createfile(self, target, filename, size, connections=None):
+        return UploadStream(self, target, filename, size, connections or self.upload_connections)
@@ -1,18 +1,42 @@
 from Crypto.Cipher import AES
+from Crypto.Util import Counter
 from megautil import a32_to_str, str_to_a32, a32_to_base64
 import json
 
 
+_ecb_ciphers = {}
+
+
+def aes_ecb_cipher(key):
+    # ECB ciphers are stateless, so one instance per key can be shared
+    cipher = _ecb_ciphers.get(key)
+    if cipher is None:
+        if len(_ecb_ciphers) >= 1024:
+            _ecb_ciphers.clear()
+        cipher = _ecb_ciphers[key] = AES.new(key, AES.MODE_ECB)
+    return cipher
+
+
 def aes_cbc_encrypt(data, key):
+    if len(data) == 16:
+        # CBC with a zero IV on a single block is ECB
+        return aes_ecb_cipher(key).encrypt(data)
     encryptor = AES.new(key, AES.MODE_CBC, '\0' * 16)
     return encryptor.encrypt(data)
 
 
 def aes_cbc_decrypt(data, key):
+    if len(data) == 16:
+        return aes_ecb_cipher(key).decrypt(data)
     decryptor = AES.new(key, AES.MODE_CBC, '\0' * 16)
     return decryptor.decrypt(data)
 
 
+def aes_ctr_cipher(key, iv, offset=0):
+    counter = Counter.new(128, initial_value=(((iv[0] << 32) + iv[1]) << 64) + offset / 16)
+    return AES.new(a32_to_str(key), AES.MODE_CTR, counter=counter)
+
+
 def aes_cbc_encrypt_a32(data, key):
     return str_to_a32(aes_cbc_encrypt(a32_to_str(data), a32_to_str(key)))
 
@@ -26,29 +50,54 @@ def stringhash(s, aeskey):
     h32 = [0, 0, 0, 0]
     for i in xrange(len(s32)):
         h32[i % 4] ^= s32[i]
+    cipher = aes_ecb_cipher(a32_to_str(aeskey))
+    h = a32_to_str(h32)
     for _ in xrange(0x4000):
-        h32 = aes_cbc_encrypt_a32(h32, aeskey)
+        h = cipher.encrypt(h)
+    h32 = str_to_a32(h)
     return a32_to_base64((h32[0], h32[2]))
 
 
 def prepare_key(a):
-    pkey = [0x93C467E3, 0x7DB0C7A4, 0xD1BE3F81, 0x0152CB56]
+    ciphers = []
+    for j in xrange(0, len(a), 4):
+        key = [0, 0, 0, 0]
+        for i in xrange(4):
+            if i + j < len(a):
+                key[i] = a[i + j]
+        ciphers.append(aes_ecb_cipher(a32_to_str(key)))
+    pkey = a32_to_str([0x93C467E3, 0x7DB0C7A4, 0xD1BE3F81, 0x0152CB56])
     for _ in xrange(0x10000):
-        for j in xrange(0, len(a), 4):
-            key = [0, 0, 0, 0]
-            for i in xrange(4):
-                if i + j < len(a):
-                    key[i] = a[i + j]
-            pkey = aes_cbc_encrypt_a32(pkey, key)
-    return pkey
+        for cipher in ciphers:
+            pkey = cipher.encrypt(pkey)
+    return str_to_a32(pkey)
 
 
 def encrypt_key(a, key):
-    return sum((aes_cbc_encrypt_a32(a[i:i+4], key) for i in xrange(0, len(a), 4)), ())
+    # each 16 bytes block is encrypted on its own: ECB over the whole key
+    return str_to_a32(aes_ecb_cipher(a32_to_str(key)).encrypt(a32_to_str(a)))
 
 
 def decrypt_key(a, key):
-    return sum((aes_cbc_decrypt_a32(a[i:i + 4], key) for i in xrange(0, len(a), 4)), ())
+    return str_to_a32(aes_ecb_cipher(a32_to_str(key)).decrypt(a32_to_str(a)))
+
+
+def chunk_mac(chunk, key, iv):
+    # CBC-MAC of the zero padded chunk: a single CBC pass, keeping the last block
+    if len(chunk) % 16:
+        chunk += '\0' * (16 - len(chunk) % 16)
+    if not chunk:
+        return (iv[0], iv[1], iv[0], iv[1])
+    encryptor = AES.new(a32_to_str(key), AES.MODE_CBC, a32_to_str((iv[0], iv[1], iv[0], iv[1])))
+    return str_to_a32(encryptor.encrypt(chunk)[-16:])
+
+
+def condense_macs(chunk_macs, key):
+    file_mac = [0, 0, 0, 0]
+    for mac in chunk_macs:
+        file_mac = [file_mac[0] ^ mac[0], file_mac[1] ^ mac[1], file_mac[2] ^ mac[2], file_mac[3] ^ mac[3]]
+        file_mac = aes_cbc_encrypt_a32(file_mac, key)
+    return (file_mac[0] ^ file_mac[1], file_mac[2] ^ file_mac[3])
 
 
 def enc_attr(attr, key):
@@ -1,125 +1,503 @@
+from megacache import BlockCache
 from megaclient import MegaClient
+from meganodes import Node, NodeTable
+from megastore import NodeStore
+from megaupload import UploadQueue
 import errno
 import fuse
 import getpass
+import logging
 import os
+import shutil
 import stat
 import tempfile
+import threading
 import time
 
 fuse.fuse_python_api = (0, 2)
 
+log = logging.getLogger('megafs')
+
+
+class MegaReader(object):
+    mode = 'rb'
+
+    def __init__(self, client, cache, file):
+        self.client = client
+        self.cache = cache
+        self.file = file
+        self.dl_url = None
+
+    def getblock(self, index):
+        block = self.cache.get(self.file, index)
+        if block is None:
+            if self.dl_url is None:
+                self.dl_url = self.client.getdownloadurl(self.file)
+            offset = index * self.cache.block_size
+            # a short response is retried, not cached as the block
+            size = max(0, min(self.cache.block_size, self.file.s - offset))
+            block = self.client.retry.call('read', self.client.fetchchunk, self.file, self.dl_url, offset, size)
+            self.cache.put(self.file, index, block)
+        return block
+
+    def read(self, size, offset):
+        if self.file.h is None:
+            return ''
+        end = min(offset + size, self.file.s)
+        block_size = self.cache.block_size
+        data = []
+        for index in xrange(offset / block_size, (end + block_size - 1) / block_size):
+            data.append(self.getblock(index))
+        skip = offset % block_size
+        return ''.join(data)[skip:skip + end - offset]
+
+    def close(self):
+        pass
+
+
+class SpoolReader(object):
+    """Reads a closed file from its spool while its upload is pending"""
+    mode = 'rb'
+
+    def __init__(self, name):
+        # stays readable when the upload removes the spool
+        self.file = open(name, 'rb')
+
+    def read(self, size, offset):
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+
+class MegaWriter(object):
+    mode = 'wb'
+
+    def __init__(self, name):
+        self.name = name
+        self.file = open(name, 'wb')
+        # written since the last upload
+        self.dirty = False
+        # an fsync uploaded part of the data: the upload on close replaces that node
+        self.uploaded = False
+
+    def write(self, buf, offset):
+        self.file.seek(offset)
+        self.file.write(buf)
+        self.dirty = True
+        return len(buf)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
 
 class MegaFS(fuse.Fuse):
     def __init__(self, client, *args, **kw):
         fuse.Fuse.__init__(self, *args, **kw)
         self.client = client
+        self.cache = None
+        self.cache_dir = None
+        self.cache_memory = 64
+        self.cache_disk = 1024
+        self.store_dir = '~/.megaclient'
+        self.store = None
+        self.poll = 1
+        self.readdirplus = False
+        self.writeback = False
+        self.upload_workers = 2
+        self.upload_spool = 1024
+        self.uploads = None
+        # paths open for writing
+        self.writing = set()
+        # metadata operations only hold self.lock briefly, so transfers no longer stall them
+        self.multithreaded = True
+        self.lock = threading.RLock()
+        self.nodes = NodeTable()
         self.hash2path = {}
-        self.files = {'/': {'t': 1, 'ts': int(time.time()), 'children': []}}
+        self.path2hash = {}
+        self.duplicates = {}
+        self.stats = {}
+        self.files = {'/': Node(t=1, ts=int(time.time()), children=[])}
 
+    def loadtree(self):
         self.client.login()
-        files = self.client.getfiles()
+        if self.store_dir:
+            self.store = NodeStore(self.store_dir)
+            self.nodes = self.client.loadfiles(self.store)
+        else:
+            self.nodes = self.client.getfiles()
 
-        for file_h, file in files.items():
-            path = self.getpath(files, file_h)
-            dirname, basename = os.path.split(path)
-            if not dirname in self.files:
-                self.files[dirname] = {'children': []}
-            self.files[dirname]['children'].append(basename)
-            if path in self.files:
-                self.files[path].update(file)
-            else:
-                self.files[path] = file
-                if file['t'] > 0:
-                    self.files[path]['children'] = []
+        for file_h in self.nodes:
+            self.addnode(file_h)
+
+    def addnode(self, hash):
+        file = self.nodes[hash]
+        path = self.getpath(self.nodes, hash)
+        dirname, basename = os.path.split(path)
+        if not dirname in self.files:
+            self.files[dirname] = Node(t=1, children=[])
+        parent = self.files[dirname]
+        parent.children.append(basename)
+        if file.t > 0:
+            parent.subdirs += 1
+        if path in self.files:
+            # placeholder created by a child seen before its parent
+            file.children = self.files[path].children
+            file.subdirs = self.files[path].subdirs
+        elif file.t > 0 and file.children is None:
+            file.children = []
+        self.files[path] = file
+        self.stats.pop(path, None)
+        self.stats.pop(dirname, None)
+        return path
+
+    def removenode(self, hash):
+        path = self.hash2path.pop(hash, None)
+        if path is None:
+            return None
+        del self.path2hash[path]
+        dirname, basename = os.path.split(path)
+        file = self.files.pop(path)
+        parent = self.files[dirname]
+        # leave a hole so that readdir offsets of the other entries stay valid
+        parent.children[parent.children.index(basename)] = None
+        if len(parent.children) > 64 and parent.children.count(None) * 2 > len(parent.children):
+            parent.children[:] = [name for name in parent.children if name is not None]
+        if file.t > 0:
+            parent.subdirs -= 1
+        self.stats.pop(path, None)
+        self.stats.pop(dirname, None)
+        return file
+
+    def updatenode(self, hash):
+        old_path = self.hash2path.get(hash)
+        old = self.removenode(hash)
+        if old is not None and old.children is not None:
+            self.nodes[hash].children = old.children
+            self.nodes[hash].subdirs = old.subdirs
+        path = self.addnode(hash)
+        if old_path is not None and path != old_path and self.files[path].children is not None:
+            # a moved or renamed folder takes its whole subtree along
+            moves = [(old_path, path)]
+            for old_dir, new_dir in moves:
+                for name in self.files[new_dir].children:
+                    if name is None:
+                        continue
+                    old_child, new_child = old_dir + '/' + name, new_dir + '/' + name
+                    child = self.files[new_child] = self.files.pop(old_child)
+                    self.stats.pop(old_child, None)
+                    if child.h is not None and self.hash2path.get(child.h) == old_child:
+                        del self.path2hash[old_child]
+                        self.hash2path[child.h] = new_child
+                        self.path2hash[new_child] = child.h
+                    if child.children is not None:
+                        moves.append((old_child, new_child))
+
+    def applychanges(self, changes):
+        with self.lock:
+            for action, hash in changes:
+                if action == 'delete':
+                    self.removenode(hash)
+                elif action == 'add':
+                    self.addnode(hash)
+                else:
+                    self.updatenode(hash)
+        if self.cache is not None:
+            self.cache.invalidate([hash for action, hash in changes if action != 'add'])
+
+    def reloadtree(self):
+        # fetch outside of the lock, and only replace the tree once the new one is complete
+        nodes = self.client.getfiles()
+        with self.lock:
+            self.hash2path = {}
+            self.path2hash = {}
+            self.duplicates = {}
+            self.stats = {}
+            self.files = {'/': Node(t=1, ts=int(time.time()), children=[])}
+            self.nodes = nodes
+            for file_h in self.nodes:
+                self.addnode(file_h)
+
+    def pollupdates(self):
+        while True:
+            try:
+                packets, sn = self.client.pollupdates(self.client.sn)
+                if packets is None:
+                    # too far behind the server: start over from a full tree
+                    self.reloadtree()
+                    continue
+                with self.lock:
+                    changes = self.client.applypackets(self.nodes, packets)
+                    self.applychanges(changes)
+            except Exception:
+                log.exception('polling for changes after %s failed', self.client.sn)
+                time.sleep(10 * self.poll)
+                continue
+            self.client.sn = sn
+            if not packets:
+                time.sleep(self.poll)
 
     def getpath(self, files, hash):
-        if not hash:
-            return ""
-        elif not hash in self.hash2path:
-            path = self.getpath(files, files[hash]['p']) + "/" + files[hash]['a']['n']
+        # walk up to the first ancestor with a known path, then assign paths on the way down
+        chain = []
+        while hash and hash not in self.hash2path:
+            chain.append(hash)
+            hash = files.parenthandle(files[hash])
+            if hash not in files:
+                # the parent is not ours, as for the root of an incoming share: the node goes at the top
+                hash = None
+        path = self.hash2path[hash] if hash else ""
+        for hash in reversed(chain):
+            path = self.uniquepath(path + "/" + files[hash].name)
+            self.hash2path[hash] = path
+            self.path2hash[path] = hash
+        return path
+
+    def uniquepath(self, path):
+        if path not in self.path2hash:
+            return path.encode()
+        # resume numbering where the last duplicate of this name stopped
+        i = self.duplicates.get(path, 1)
+        filename, fileext = os.path.splitext(path)
+        unique_path = filename + ' (%d)' % i + fileext
+        while unique_path in self.path2hash:
+            i += 1
+            unique_path = filename + ' (%d)' % i + fileext
+        self.duplicates[path] = i + 1
+        return unique_path.encode()
 
-            i = 1
-            filename, fileext = os.path.splitext(path)
-            while path in self.hash2path.values():
-                path = filename + ' (%d)' % i + fileext
-                i += 1
+    def fsinit(self):
+        self.cache = BlockCache(self.cache_dir, int(self.cache_memory) << 20, int(self.cache_disk) << 20)
+        if self.writeback:
+            self.uploads = UploadQueue(self.client, int(self.upload_workers), int(self.upload_spool) << 20)
+        self.poll = float(self.poll)
+        if self.poll > 0:
+            poller = threading.Thread(target=self.pollupdates)
+            poller.daemon = True
+            poller.start()
 
-            self.hash2path[hash] = path.encode()
-        return self.hash2path[hash]
+    def fsdestroy(self):
+        if self.uploads is not None:
+            for path, job in self.uploads.drain(retry=True).items():
+                log.error('upload of %s failed at unmount (%s), its data is kept in %s', path, job.error, job.src_path)
+        self.cache.flush()
+        if self.store is not None:
+            with self.lock:
+                self.client.savefiles(self.store, self.nodes)
+        self.client.transport.close()
 
     def getattr(self, path):
-        if path not in self.files:
-            return -errno.ENOENT
+        if self.uploads is not None:
+            job = self.uploads.pending(path)
+            if job is not None:
+                # closed but not uploaded yet: the spool has the content
+                with self.lock:
+                    if path not in self.files:
+                        return -errno.ENOENT
+                    return self.makestat(self.files[path], job.size)
+        st = self.stats.get(path)
+        if st is None:
+            with self.lock:
+                if path not in self.files:
+                    return -errno.ENOENT
+                st = self.stats[path] = self.makestat(self.files[path])
+        return st
 
+    def makestat(self, file, size=None):
         st = fuse.Stat()
-        file = self.files[path]
-        st.st_atime = file['ts']
+        st.st_atime = file.ts
         st.st_mtime = st.st_atime
         st.st_ctime = st.st_atime
-        if file['t'] == 0:
+        if file.t == 0:
             st.st_mode = stat.S_IFREG | 0666
             st.st_nlink = 1
-            st.st_size = file['s']
+            st.st_size = file.s if size is None else size
         else:
             st.st_mode = stat.S_IFDIR | 0755
-            st.st_nlink = 2 + len([child for child in file['children'] if self.files[os.path.join(path, child)]['t'] > 0])
+            st.st_nlink = 2 + file.subdirs
             st.st_size = 4096
         return st
 
     def readdir(self, path, offset):
-        dirents = ['.', '..'] + self.files[path]['children']
-        for r in dirents:
-            yield fuse.Direntry(r)
+        # the offset given with an entry is where the listing resumes after it
+        dirents = []
+        with self.lock:
+            children = self.files[path].children
+            for index, name in enumerate(['.', '..'][offset:]):
+                dirents.append(fuse.Direntry(name, offset=offset + index + 1, type=stat.S_IFDIR >> 12))
+            for index in xrange(max(offset - 2, 0), len(children)):
+                name = children[index]
+                if name is None:
+                    continue
+                child_path = os.path.join(path, name)
+                child = self.files[child_path]
+                if self.readdirplus:
+                    self.getattr(child_path)
+                dirents.append(fuse.Direntry(name, offset=index + 3, type=(stat.S_IFDIR if child.t > 0 else stat.S_IFREG) >> 12))
+        # yield outside of the lock: the consumer may be slow
+        for dirent in dirents:
+            yield dirent
 
     def mknod(self, path, mode, dev):
-        if path in self.files:
-            return -errno.EEXIST
+        with self.lock:
+            if path in self.files:
+                return -errno.EEXIST
 
-        dirname, basename = os.path.split(path)
-        self.files[dirname]['children'].append(basename)
-        self.files[path] = {'t': 0, 'ts': int(time.time()), 's': 0}
+            dirname, basename = os.path.split(path)
+            self.files[dirname].children.append(basename)
+            self.files[path] = Node(t=0, ts=int(time.time()), s=0)
+            self.stats.pop(path, None)
 
     def open(self, path, flags):
-        if path not in self.files:
+        job = self.uploads.pending(path) if self.uploads is not None else None
+        if (flags & 3) == os.O_RDONLY and job is not None:
+            try:
+                return SpoolReader(job.src_path)
+            except IOError:
+                # uploaded in the meantime
+                pass
+        file = self.files.get(path)
+        if file is None:
             return -errno.ENOENT
 
         if (flags & 3) == os.O_RDONLY:
-            (tmp_f, tmp_path) = tempfile.mkstemp(prefix='mega')
-            os.close(tmp_f)
-            if 'h' not in self.files[path]:
-                return open(tmp_path, "rb")
-            elif self.client.downloadfile(self.files[path], tmp_path):
-                return open(tmp_path, "rb")
-            else:
-                return -errno.EACCESS
+            return MegaReader(self.client, self.cache, file)
         elif (flags & 3) == os.O_WRONLY:
-            if 'h' in self.files[path]:
+            if file.h is not None:
                 return -errno.EEXIST
+            with self.lock:
+                # one upload per file: a second writer would create a second node
+                job = self.uploads.pending(path) if self.uploads is not None else None
+                if path in self.writing or (job is not None and job.error is None):
+                    return -errno.EBUSY
+                self.writing.add(path)
             (tmp_f, tmp_path) = tempfile.mkstemp(prefix='mega')
             os.close(tmp_f)
-            return open(tmp_path, "wb")
+            return MegaWriter(tmp_path)
         else:
             return -errno.EINVAL
 
     def read(self, path, size, offset, fh):
-        fh.seek(offset)
-        return fh.read(size)
+        return fh.read(size, offset)
 
     def write(self, path, buf, offset, fh):
-        fh.seek(offset)
-        fh.write(buf)
-        return len(buf)
+        return fh.write(buf, offset)
 
     def release(self, path, flags, fh):
         fh.close()
         if fh.mode == "wb":
-            dirname, basename = os.path.split(path)
-            uploaded_file = self.client.uploadfile(fh.name, self.files[dirname]['h'], basename)
-            if 'f' in uploaded_file:
-                uploaded_file = self.client.processfile(uploaded_file['f'][0])
-                self.files[path] = uploaded_file
-        os.unlink(fh.name)
+            try:
+                if not fh.dirty:
+                    os.unlink(fh.name)
+                elif self.uploads is not None:
+                    self.submitupload(path, fh.name, self.replaced(path, fh))
+                else:
+                    try:
+                        self.upload(path, fh.name, self.replaced(path, fh))
+                    finally:
+                        os.unlink(fh.name)
+            finally:
+                # only once the upload is queued, so that a new writer sees it
+                with self.lock:
+                    self.writing.discard(path)
+
+    def replaced(self, path, fh):
+        # the node of an earlier fsync of this handle, if any
+        if not fh.uploaded:
+            return None
+        with self.lock:
+            return self.files[path].h
+
+    def upload(self, path, src_path, replaces=None):
+        dirname, basename = os.path.split(path)
+        with self.lock:
+            target = self.files[dirname].h
+        self.uploaded(path, self.client.uploadfile(src_path, target, basename), replaces)
+
+    def submitupload(self, path, src_path, replaces=None):
+        dirname, basename = os.path.split(path)
+        with self.lock:
+            target = self.files[dirname].h
+        self.uploads.submit(path, src_path, target, basename, lambda uploaded_file: self.uploaded(path, uploaded_file, replaces))
+
+    def uploaded(self, path, uploaded_file, replaces=None):
+        if 'f' in uploaded_file:
+            uploaded_file = self.client.processfile(uploaded_file['f'][0])
+            with self.lock:
+                node = self.nodes.add(uploaded_file)
+                if replaces is not None and replaces != node.h:
+                    # the new node takes over the path of the partial one
+                    self.hash2path.pop(replaces, None)
+                    if replaces in self.nodes:
+                        self.nodes.remove(replaces)
+                self.hash2path[node.h] = path
+                self.path2hash[path] = node.h
+                self.files[path] = node
+                self.stats.pop(path, None)
+            if replaces is not None and replaces != node.h:
+                res = self.client.deletenode(replaces)
+                if isinstance(res, int) and res < 0:
+                    log.warning('cannot delete the earlier upload %s of %s: Mega API error %d', replaces, path, res)
+
+    def flush(self, path, fh=None):
+        # close comes through here: report earlier failures, but leave the upload to release
+        if self.uploads is not None and self.uploads.wait(path):
+            return -errno.EIO
+
+    def fsync(self, path, isfsyncfile, fh=None):
+        if fh is not None and fh.mode == 'wb' and fh.dirty:
+            # the handle stays open: upload a copy of what was written so far
+            fh.flush()
+            fh.dirty = False
+            replaces = self.replaced(path, fh)
+            if self.uploads is None:
+                try:
+                    self.upload(path, fh.name, replaces)
+                except Exception:
+                    fh.dirty = True
+                    return -errno.EIO
+                fh.uploaded = True
+                return
+            (tmp_f, tmp_path) = tempfile.mkstemp(prefix='mega')
+            os.close(tmp_f)
+            shutil.copyfile(fh.name, tmp_path)
+            self.submitupload(path, tmp_path, replaces)
+            if self.uploads.wait(path):
+                fh.dirty = True
+                return -errno.EIO
+            fh.uploaded = True
+            return
+        elif self.uploads is not None:
+            self.uploads.retry(path)
+        if self.uploads is not None and self.uploads.wait(path):
+            return -errno.EIO
+
+    def xattrs(self):
+        values = {}
+        if self.uploads is not None:
+            for name, value in self.uploads.stats().items():
+                values['user.megafs.upload.' + name] = value
+        for name, value in self.client.metrics.stats().items():
+            values['user.megafs.requests.' + name] = value
+        return values
+
+    def getxattr(self, path, name, size):
+        if path != '/' or not name.startswith('user.megafs.'):
+            return -errno.ENODATA
+        value = str(self.xattrs().get(name, ''))
+        if not value:
+            return -errno.ENODATA
+        return len(value) if size == 0 else value
+
+    def listxattr(self, path, size):
+        names = []
+        if path == '/':
+            names = sorted(self.xattrs())
+        return len(''.join(names)) + len(names) if size == 0 else names
 
 if __name__ == '__main__':
     email = raw_input("Email [%s]: " % getpass.getuser())
@@ -128,5 +506,15 @@ if __name__ == '__main__':
     password = getpass.getpass()
     client = MegaClient(email, password)
     fs = MegaFS(client)
-    fs.parse(errex=1)
+    fs.parser.add_option(mountopt='cache_dir', metavar='PATH', help='directory where decrypted blocks are kept between mounts, as plaintext readable by the owner only')
+    fs.parser.add_option(mountopt='cache_memory', metavar='MB', help='memory block cache size [default: %default]', default=fs.cache_memory)
+    fs.parser.add_option(mountopt='cache_disk', metavar='MB', help='disk block cache size [default: %default]', default=fs.cache_disk)
+    fs.parser.add_option(mountopt='store_dir', metavar='PATH', help='directory of the encrypted node table snapshot, empty to disable [default: %default]', default=fs.store_dir)
+    fs.parser.add_option(mountopt='poll', metavar='SECONDS', help='delay between polls for remote changes, 0 to disable [default: %default]', default=fs.poll)
+    fs.parser.add_option(mountopt='readdirplus', action='store_true', help='prepare the attributes of listed entries while listing a directory')
+    fs.parser.add_option(mountopt='writeback', action='store_true', help='upload closed files in the background')
+    fs.parser.add_option(mountopt='upload_workers', metavar='N', help='parallel background uploads [default: %default]', default=fs.upload_workers)
+    fs.parser.add_option(mountopt='upload_spool', metavar='MB', help='closed files waiting for upload before close blocks [default: %default]', default=fs.upload_spool)
+    fs.parse(values=fs, errex=1)
+    fs.loadtree()
     fs.main()
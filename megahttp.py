@@ -0,0 +1,73 @@
+import httplib
+import socket
+import threading
+import urlparse
+
+
+class HTTPError(IOError):
+    def __init__(self, url, status, reason):
+        IOError.__init__(self, 'HTTP error %d (%s) on %s' % (status, reason, url))
+        self.url = url
+        self.status = status
+
+
+class HTTPTransport(object):
+    """Keep-alive HTTP(S) connections, pooled per host with a connection limit"""
+
+    def __init__(self, max_connections=8, timeout=60):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle = {}
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def connect(self, scheme, netloc, timeout):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=timeout)
+        return httplib.HTTPConnection(netloc, timeout=timeout)
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        parts = urlparse.urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        if timeout is None:
+            timeout = self.timeout
+        with self.lock:
+            if host not in self.limits:
+                self.limits[host] = threading.BoundedSemaphore(self.max_connections)
+                self.idle[host] = []
+            limit = self.limits[host]
+        with limit:
+            while True:
+                with self.lock:
+                    connection = self.idle[host].pop() if self.idle[host] else None
+                reused = connection is not None
+                if connection is None:
+                    connection = self.connect(parts.scheme, parts.netloc, timeout)
+                elif connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                try:
+                    connection.request(method, path, body, headers or {})
+                    response = connection.getresponse()
+                    data = response.read()
+                except (httplib.HTTPException, socket.error):
+                    connection.close()
+                    if reused:
+                        # the server may have dropped an idle keep-alive connection: retry on a fresh one
+                        continue
+                    raise
+                if response.will_close:
+                    connection.close()
+                else:
+                    with self.lock:
+                        self.idle[host].append(connection)
+                if response.status >= 400:
+                    raise HTTPError(url, response.status, response.reason)
+                return data
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+                del connections[:]
@@ -0,0 +1,191 @@
+from array import array
+from megacrypto import aes_cbc_encrypt, aes_ctr_cipher
+from megautil import a32_to_str, str_to_a32
+import bisect
+import fnmatch
+import os
+import re
+import struct
+
+# magic, version, entry count, offset and number item sizes, nonce, key check, sequence number length
+HEADER = struct.Struct('>8sHIBB8s16sH')
+# lengths of the path, lowercase path and lowercase name blobs
+BLOBS = struct.Struct('>QQQ')
+
+
+class Strings(object):
+    """Read only list of the utf-8 strings of a newline separated blob"""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.blob[self.offsets[index]:self.offsets[index + 1] - 1].decode('utf-8')
+
+
+class Handles(object):
+    """Read only list of node handles, padded to 8 bytes each"""
+
+    def __init__(self, blob):
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.blob) / 8
+
+    def __getitem__(self, index):
+        return self.blob[index * 8:index * 8 + 8].rstrip('\0')
+
+
+class PathIndex(object):
+    """Paths of a tree in sorted order, with their lowercase paths and names
+    joined in utf-8 blobs so that substring and glob searches run in C and
+    only touch the matching entries.
+
+    The blobs and their offsets are what the index file holds, so that
+    loading it is a decryption and no rebuild.
+    """
+
+    magic = 'MEGAINDX'
+    version = 1
+
+    def __init__(self, sn, blobs, offsets, handles, sizes, mtimes):
+        self.sn = sn
+        self.path_blob, self.lower_blob, self.name_blob = blobs
+        self.path_offsets, self.lower_offsets, self.name_offsets = offsets
+        self.paths = Strings(self.path_blob, self.path_offsets)
+        self.handles = Handles(handles)
+        self.sizes = sizes
+        self.mtimes = mtimes
+
+    @classmethod
+    def build(cls, entries, sn=None):
+        # entries are (path, handle, size, mtime)
+        entries = sorted(entries)
+        if any(len(entry[1]) > 8 for entry in entries):
+            raise ValueError('Node handles are at most 8 characters')
+        paths = [entry[0] for entry in entries]
+        blobs, offsets = zip(
+            cls.blob([path.encode('utf-8') for path in paths]),
+            cls.blob([path.lower().encode('utf-8') for path in paths]),
+            cls.blob([path[path.rfind('/') + 1:].lower().encode('utf-8') for path in paths]))
+        handles = ''.join(str(entry[1]).ljust(8, '\0') for entry in entries)
+        return cls(sn, blobs, offsets, handles, array('l', [entry[2] for entry in entries]), array('l', [entry[3] for entry in entries]))
+
+    @classmethod
+    def blob(cls, strings):
+        offsets = array('I', [0])
+        offset = 0
+        for string in strings:
+            offset += len(string) + 1
+            offsets.append(offset)
+        return '\n'.join(strings) + '\n', offsets
+
+    @classmethod
+    def keycheck(cls, master_key, nonce):
+        return aes_cbc_encrypt(nonce + cls.magic, a32_to_str(master_key))
+
+    @classmethod
+    def load(cls, filename, master_key):
+        # None when there is no usable index, so that the caller rebuilds it
+        try:
+            with open(filename, 'rb') as handle:
+                data = handle.read()
+            magic, version, count, offset_size, number_size, nonce, check, sn_length = HEADER.unpack_from(data, 0)
+            if magic != cls.magic or version != cls.version or (offset_size, number_size) != (array('I').itemsize, array('l').itemsize):
+                return None
+            if check != cls.keycheck(master_key, nonce):
+                return None
+            body = HEADER.size + sn_length
+            sn = data[HEADER.size:body] or None
+            blob_lengths = BLOBS.unpack_from(data, body)
+            body += BLOBS.size
+            data = aes_ctr_cipher(master_key, str_to_a32(nonce)).decrypt(data[body:])
+        except (IOError, OSError, struct.error):
+            return None
+        # blobs, handles, the offsets of each blob, then sizes and mtimes, as native arrays
+        offsets_length = 3 * (count + 1) * offset_size
+        if len(data) != sum(blob_lengths) + count * 8 + offsets_length + 2 * count * number_size:
+            return None
+        blobs = []
+        position = 0
+        for length in blob_lengths:
+            blobs.append(data[position:position + length])
+            position += length
+        handles = data[position:position + count * 8]
+        position += count * 8
+        offsets = array('I')
+        offsets.fromstring(data[position:position + offsets_length])
+        numbers = array('l')
+        numbers.fromstring(data[position + offsets_length:])
+        offsets = [offsets[i * (count + 1):(i + 1) * (count + 1)] for i in xrange(3)]
+        return cls(sn, blobs, offsets, handles, numbers[:count], numbers[count:])
+
+    def write(self, filename, master_key):
+        sn = str(self.sn or '')
+        blobs = (self.path_blob, self.lower_blob, self.name_blob)
+        offsets = self.path_offsets + self.lower_offsets + self.name_offsets
+        numbers = self.sizes + self.mtimes
+        nonce = os.urandom(8)
+        data = aes_ctr_cipher(master_key, str_to_a32(nonce)).encrypt(''.join(blobs) + self.handles.blob + offsets.tostring() + numbers.tostring())
+        header = HEADER.pack(self.magic, self.version, len(self), offsets.itemsize, numbers.itemsize, nonce, self.keycheck(master_key, nonce), len(sn))
+        tmp_filename = '%s.tmp-%d' % (filename, os.getpid())
+        with os.fdopen(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb') as handle:
+            handle.write(header + sn + BLOBS.pack(*[len(blob) for blob in blobs]) + data)
+        os.rename(tmp_filename, filename)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def subtree(self, path):
+        # index range of the entries below path; '0' follows '/', so it bounds the prefix
+        prefix = path.rstrip(u'/') + u'/'
+        return bisect.bisect_left(self.paths, prefix), bisect.bisect_left(self.paths, prefix[:-1] + u'0')
+
+    def search(self, blob, offsets, needle, lo, hi):
+        # indexes in [lo, hi) whose string contains needle
+        needle = needle.lower().encode('utf-8')
+        end = offsets[hi]
+        position = blob.find(needle, offsets[lo], end)
+        while position != -1 and position < end:
+            index = bisect.bisect_right(offsets, position, lo, hi + 1) - 1
+            if position + len(needle) < offsets[index + 1]:
+                yield index
+            position = blob.find(needle, offsets[index + 1], end)
+
+    def query(self, path=None, path_filter=None, name_filter=None, glob=None, min_size=None, max_size=None, newer=None, older=None):
+        lo, hi = self.subtree(path) if path else (0, len(self))
+        if hi <= lo:
+            return
+        if path_filter:
+            candidates = self.search(self.lower_blob, self.lower_offsets, path_filter, lo, hi)
+        elif name_filter or glob:
+            # narrow a glob down to the entries containing its longest literal part
+            needle = name_filter or max(re.split(r'\[[^\]]*\]|[*?]', glob), key=len)
+            candidates = self.search(self.name_blob, self.name_offsets, needle, lo, hi)
+        else:
+            candidates = xrange(lo, hi)
+        for index in candidates:
+            if name_filter and path_filter and name_filter.lower() not in self.name(index).lower():
+                continue
+            if glob and not fnmatch.fnmatchcase(self.name(index).lower(), glob.lower()):
+                continue
+            if min_size is not None and self.sizes[index] < min_size:
+                continue
+            if max_size is not None and self.sizes[index] > max_size:
+                continue
+            if newer is not None and self.mtimes[index] < newer:
+                continue
+            if older is not None and self.mtimes[index] > older:
+                continue
+            yield index
+
+    def name(self, index):
+        path = self.paths[index]
+        return path[path.rfind('/') + 1:]
+
+    def level(self, index):
+        return self.paths[index].count('/') - 1
@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+import time
+
+
+class TransferJournal(object):
+    """Completed chunks of a transfer, appended after each chunk so that an
+    interrupted transfer can skip them when restarted.
+
+    The first line holds the identity, creation time and fields of the
+    transfer, each following line one [chunk start, value] pair.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.expanduser(filename)
+        self.lock = threading.Lock()
+        self.state = None
+
+    def resume(self, identity, max_age=None):
+        # returns the completed chunks {chunk start: value} of the same transfer, or starts a new journal
+        state = None
+        torn = False
+        try:
+            with open(self.filename, 'rb') as handle:
+                state = json.loads(handle.readline())
+                state['chunks'] = {}
+                for line in handle:
+                    try:
+                        chunk_start, value = json.loads(line)
+                    except ValueError:
+                        # the last line of an interrupted write
+                        torn = True
+                        break
+                    state['chunks'][chunk_start] = value
+        except (IOError, OSError, ValueError, TypeError):
+            state = None
+        if not isinstance(state, dict) or state.get('identity') != identity or (max_age is not None and time.time() - state['created'] > max_age):
+            self.reset(identity)
+            return {}
+        self.state = state
+        if torn:
+            # the next chunks are appended after a complete line
+            with self.lock:
+                self.save()
+        return dict(state['chunks'])
+
+    def reset(self, identity):
+        with self.lock:
+            self.state = {'identity': identity, 'created': time.time(), 'fields': {}, 'chunks': {}}
+            self.save()
+
+    @property
+    def fields(self):
+        return self.state['fields']
+
+    def setfields(self, **fields):
+        with self.lock:
+            self.state['fields'].update(fields)
+            self.save()
+
+    def record(self, chunk_start, value):
+        with self.lock:
+            self.state['chunks'][chunk_start] = value
+            fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+            try:
+                os.write(fd, json.dumps([chunk_start, value]) + '\n')
+            finally:
+                os.close(fd)
+
+    def save(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, mode=0700)
+        # upload journals hold the upload key
+        tmp_filename = '%s.tmp-%d' % (self.filename, os.getpid())
+        with os.fdopen(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb') as handle:
+            handle.write(json.dumps(dict((name, value) for name, value in self.state.items() if name != 'chunks')) + '\n')
+            for chunk_start, value in sorted(self.state['chunks'].items()):
+                handle.write(json.dumps([chunk_start, value]) + '\n')
+        os.rename(tmp_filename, self.filename)
+
+    def delete(self):
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
@@ -0,0 +1,117 @@
+from megautil import a32_to_str, str_to_a32
+
+
+class Node(object):
+    """A decrypted node; key packs k, iv and meta_mac as a binary string"""
+    __slots__ = ('h', 'parent', 't', 'name', 's', 'ts', 'key', 'children', 'subdirs')
+
+    def __init__(self, h=None, parent=-1, t=0, name=None, s=0, ts=0, key=None, children=None):
+        self.h = h
+        self.parent = parent
+        self.t = t
+        self.name = name
+        self.s = s
+        self.ts = ts
+        self.key = key
+        # free for the frontend: MegaFS keeps the directory entries and subdirectory count here
+        self.children = children
+        self.subdirs = 0
+
+    @property
+    def k(self):
+        return str_to_a32(self.key[:16]) if self.key else None
+
+    @property
+    def iv(self):
+        return str_to_a32(self.key[16:24]) + (0, 0) if self.key else None
+
+    @property
+    def meta_mac(self):
+        return str_to_a32(self.key[24:32]) if self.key else None
+
+
+class NodeTable(object):
+    """Nodes indexed by handle, linked to their parent by integer id"""
+
+    def __init__(self, files=()):
+        self.handles = []
+        self.ids = {}
+        self.nodes = []
+        self.names = {}
+        for file in files:
+            self.add(file)
+
+    def id(self, handle):
+        if handle not in self.ids:
+            self.ids[handle] = len(self.handles)
+            self.handles.append(handle)
+            self.nodes.append(None)
+        return self.ids[handle]
+
+    def intern(self, name):
+        return self.names.setdefault(name, name)
+
+    def add(self, file):
+        # file is a node dict processed by MegaClient.processfiles
+        attributes = file.get('a')
+        if isinstance(attributes, dict) and 'n' in attributes:
+            name = attributes['n']
+        else:
+            name = u'?(%s)' % (file['h'],)
+        key = None
+        if isinstance(file.get('k'), (tuple, list)):
+            if file['t'] == 0:
+                key = a32_to_str(tuple(file['k']) + tuple(file['iv'][:2]) + tuple(file['meta_mac']))
+            else:
+                key = a32_to_str(file['k'])
+        return self.addnode(file['h'], file.get('p') or None, file['t'], name, file.get('s', 0), file.get('ts', 0), key)
+
+    def addnode(self, h, p, t, name, s, ts, key):
+        node_id = self.id(h)
+        node = self.nodes[node_id]
+        if node is None:
+            node = self.nodes[node_id] = Node(h=self.handles[node_id])
+        node.parent = self.id(p) if p else -1
+        node.t = t
+        node.name = self.intern(name)
+        node.s = s
+        node.ts = ts
+        node.key = key
+        return node
+
+    def remove(self, handle):
+        self.nodes[self.ids[handle]] = None
+
+    def parenthandle(self, node):
+        return self.handles[node.parent] if node.parent >= 0 else None
+
+    def __contains__(self, handle):
+        return handle in self.ids and self.nodes[self.ids[handle]] is not None
+
+    def __getitem__(self, handle):
+        node = self.nodes[self.ids[handle]]
+        if node is None:
+            raise KeyError(handle)
+        return node
+
+    def __iter__(self):
+        return (node.h for node in self.nodes if node is not None)
+
+    def __len__(self):
+        return sum(1 for node in self.nodes if node is not None)
+
+    def values(self):
+        return [node for node in self.nodes if node is not None]
+
+    def items(self):
+        return [(node.h, node) for node in self.nodes if node is not None]
+
+    def export(self):
+        return [(node.h, self.parenthandle(node), node.t, node.name, node.s, node.ts, node.key.encode('hex') if node.key else None) for node in self.nodes if node is not None]
+
+    @classmethod
+    def fromrows(cls, rows):
+        table = cls()
+        for h, p, t, name, s, ts, key in rows:
+            table.addnode(h, p, t, name, s, ts, key.decode('hex') if key else None)
+        return table
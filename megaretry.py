@@ -0,0 +1,102 @@
+from megahttp import HTTPError
+import httplib
+import random
+import socket
+import threading
+import time
+
+EAGAIN = -3
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class RequestMetrics(object):
+    """Request, retry, error code and latency counters per request kind"""
+
+    def __init__(self):
+        self.kinds = {}
+        self.lock = threading.Lock()
+
+    def counters(self, kind):
+        if kind not in self.kinds:
+            self.kinds[kind] = {'requests': 0, 'retries': 0, 'errors': {}, 'latency': [0] * (len(LATENCY_BUCKETS) + 1)}
+        return self.kinds[kind]
+
+    def record(self, kind, seconds, error=None):
+        milliseconds = seconds * 1000
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and milliseconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        with self.lock:
+            counters = self.counters(kind)
+            counters['requests'] += 1
+            counters['latency'][bucket] += 1
+            if error is not None:
+                counters['errors'][error] = counters['errors'].get(error, 0) + 1
+
+    def retry(self, kind):
+        with self.lock:
+            self.counters(kind)['retries'] += 1
+
+    def stats(self):
+        # flat name -> count mapping, e.g. 'g.requests', 'g.errors.-3', 'download.latency.250ms'
+        stats = {}
+        with self.lock:
+            for kind, counters in self.kinds.items():
+                stats['%s.requests' % kind] = counters['requests']
+                stats['%s.retries' % kind] = counters['retries']
+                for error, count in counters['errors'].items():
+                    stats['%s.errors.%s' % (kind, error)] = count
+                for bound, count in zip(LATENCY_BUCKETS + ('inf',), counters['latency']):
+                    if count:
+                        stats['%s.latency.%sms' % (kind, bound)] = count
+        return stats
+
+
+class RetryPolicy(object):
+    """Retries transient failures with exponential backoff and full jitter"""
+
+    def __init__(self, metrics=None, attempts=6, base_delay=0.25, max_delay=30.):
+        self.metrics = metrics if metrics is not None else RequestMetrics()
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def errorcode(self, error):
+        # Mega error codes are negative, HTTP statuses positive
+        if isinstance(error, HTTPError):
+            return error.status
+        if isinstance(getattr(error, 'code', None), int):
+            return error.code
+        return error.__class__.__name__
+
+    def transient(self, error):
+        if isinstance(error, HTTPError):
+            return error.status >= 500 or error.status == 429
+        if isinstance(error, (socket.error, httplib.HTTPException)):
+            return True
+        return getattr(error, 'code', None) == EAGAIN
+
+    def backoff(self, kind, attempt):
+        # sleep before retry number attempt + 1, or return False once the attempts are exhausted
+        if attempt + 1 >= self.attempts:
+            return False
+        self.metrics.retry(kind)
+        time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+        return True
+
+    def call(self, kind, func, *args):
+        attempt = 0
+        while True:
+            start_time = time.time()
+            try:
+                result = func(*args)
+            except Exception, e:
+                self.metrics.record(kind, time.time() - start_time, self.errorcode(e))
+                if not self.transient(e) or not self.backoff(kind, attempt):
+                    raise
+                attempt += 1
+                continue
+            self.metrics.record(kind, time.time() - start_time)
+            return result
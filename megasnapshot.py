@@ -0,0 +1,158 @@
+from megacrypto import aes_cbc_encrypt, aes_ctr_cipher
+from meganodes import Node
+from megautil import a32_to_str, str_to_a32
+import mmap
+import os
+import struct
+
+# magic, version, record count, nonce, key check, sequence number length
+HEADER = struct.Struct('>8sHI8s16sH')
+# handle, parent record, type, size, timestamp, key length, key, path offset, path length
+RECORD = struct.Struct('>8siBqqB32sII')
+HANDLE = struct.Struct('>8sI')
+
+
+class TreeSnapshot(object):
+    """Versioned binary snapshot of a node tree, read lazily through mmap.
+
+    After the header come three sections, encrypted with AES-CTR so that
+    any record can be decrypted on its own: fixed size node records sorted
+    by path, (handle, record) pairs sorted by handle, and the utf-8 paths.
+    """
+
+    magic = 'MEGATREE'
+    version = 2
+
+    def __init__(self, filename, master_key):
+        self.master_key = master_key
+        with open(filename, 'rb') as handle:
+            self.map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, nonce, check, sn_length = HEADER.unpack_from(self.map, 0)
+        if magic != self.magic or version != self.version:
+            self.map.close()
+            raise ValueError('Not a version %d tree snapshot' % (self.version,))
+        if check != self.keycheck(master_key, nonce):
+            self.map.close()
+            raise ValueError('Tree snapshot of another account')
+        self.nonce = str_to_a32(nonce)
+        self.sn = self.map[HEADER.size:HEADER.size + sn_length] or None
+        self.body = HEADER.size + sn_length
+        self.handles_offset = self.count * RECORD.size
+        self.paths_offset = self.handles_offset + self.count * HANDLE.size
+
+    @classmethod
+    def keycheck(cls, master_key, nonce):
+        # the nonce and magic encrypted as one block, which the CTR counter blocks of the body never reach
+        return aes_cbc_encrypt(nonce + cls.magic, a32_to_str(master_key))
+
+    @classmethod
+    def load(cls, filename, master_key):
+        # None when there is no usable snapshot, so that the caller rebuilds it
+        try:
+            return cls(filename, master_key)
+        except (IOError, OSError, ValueError, struct.error, mmap.error):
+            return None
+
+    @classmethod
+    def write(cls, filename, master_key, sn, files):
+        # files is a NodeTable; nodes whose parent is not in it are at the top
+        nodes = files.nodes
+        children = {}
+        for node in nodes:
+            if node is not None:
+                parent = node.parent if node.parent >= 0 and nodes[node.parent] is not None else -1
+                children.setdefault(parent, []).append(node)
+        entries = []
+        stack = [(u'', children.get(-1, []))]
+        while stack:
+            parentpath, siblings = stack.pop()
+            for node in siblings:
+                path = parentpath + u'/' + node.name
+                entries.append((path, node))
+                node_id = files.ids[node.h]
+                if node_id in children:
+                    stack.append((path, children[node_id]))
+        entries.sort(key=lambda entry: entry[0])
+
+        records = {}
+        for i, (path, node) in enumerate(entries):
+            records[node.h] = i
+        if any(len(handle) > 8 for handle in records):
+            raise ValueError('Node handles are at most 8 characters')
+        body = []
+        paths = []
+        offset = 0
+        pack = RECORD.pack
+        for path, node in entries:
+            path = path.encode('utf-8')
+            key = node.key or ''
+            body.append(pack(str(node.h), records[files.handles[node.parent]] if node.parent >= 0 and nodes[node.parent] is not None else -1, node.t, node.s, node.ts, len(key), key, offset, len(path)))
+            paths.append(path)
+            offset += len(path)
+        body.extend(HANDLE.pack(str(handle), records[handle]) for handle in sorted(records))
+        body.extend(paths)
+
+        nonce = os.urandom(8)
+        sn = str(sn or '')
+        data = aes_ctr_cipher(master_key, str_to_a32(nonce)).encrypt(''.join(body))
+        tmp_filename = '%s.tmp-%d' % (filename, os.getpid())
+        with os.fdopen(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb') as handle:
+            handle.write(HEADER.pack(cls.magic, cls.version, len(entries), nonce, cls.keycheck(master_key, nonce), len(sn)) + sn + data)
+        os.rename(tmp_filename, filename)
+
+    def read(self, offset, size):
+        # CTR is positioned on a 16 bytes boundary of the body
+        start = offset - offset % 16
+        data = self.map[self.body + start:self.body + offset + size]
+        return aes_ctr_cipher(self.master_key, self.nonce, start).decrypt(data)[offset - start:]
+
+    def __len__(self):
+        return self.count
+
+    def record(self, index):
+        return RECORD.unpack(self.read(index * RECORD.size, RECORD.size))
+
+    def path(self, index):
+        offset, length = self.record(index)[-2:]
+        return self.read(self.paths_offset + offset, length).decode('utf-8')
+
+    def node(self, index):
+        h, parent, t, s, ts, key_length, key, offset, length = self.record(index)
+        path = self.read(self.paths_offset + offset, length).decode('utf-8')
+        return Node(h=h.rstrip('\0'), parent=parent, t=t, name=path[path.rfind('/') + 1:], s=s, ts=ts, key=key[:key_length] or None)
+
+    def findpath(self, path):
+        # record index of path, or -1
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self.path(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.count and self.path(lo) == path else -1
+
+    def findhandle(self, handle):
+        handle = str(handle).ljust(8, '\0')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            entry_handle, index = HANDLE.unpack(self.read(self.handles_offset + mid * HANDLE.size, HANDLE.size))
+            if entry_handle == handle:
+                return index
+            if entry_handle < handle:
+                lo = mid + 1
+            else:
+                hi = mid
+        return -1
+
+    def entries(self):
+        # (path, handle, size, timestamp) of every record, decrypting each section at once
+        records = self.read(0, self.handles_offset)
+        paths = self.read(self.paths_offset, len(self.map) - self.body - self.paths_offset)
+        for i in xrange(self.count):
+            h, parent, t, s, ts, key_length, key, offset, length = RECORD.unpack_from(records, i * RECORD.size)
+            yield paths[offset:offset + length].decode('utf-8'), h.rstrip('\0'), s, ts
+
+    def close(self):
+        self.map.close()
@@ -0,0 +1,44 @@
+from megacrypto import aes_ctr_cipher
+from megautil import a32_to_str, str_to_a32
+import json
+import os
+import zlib
+
+
+class NodeStore(object):
+    """Decrypted node table snapshot, stored encrypted with the account master key"""
+
+    magic = 'MEGANODES2'
+
+    def __init__(self, dirname, filename='nodes'):
+        self.dirname = os.path.expanduser(dirname)
+        self.filename = os.path.join(self.dirname, filename)
+
+    def load(self, master_key):
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename, 'rb') as handle:
+            data = handle.read()
+        if not data.startswith(self.magic):
+            return None
+        nonce = str_to_a32(data[len(self.magic):len(self.magic) + 8])
+        data = aes_ctr_cipher(master_key, nonce).decrypt(data[len(self.magic) + 8:])
+        # a snapshot from another account does not decrypt to a valid stream
+        try:
+            return json.loads(zlib.decompress(data))
+        except (zlib.error, ValueError):
+            return None
+
+    def save(self, master_key, snapshot):
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname, mode=0700)
+        nonce = str_to_a32(os.urandom(8))
+        data = aes_ctr_cipher(master_key, nonce).encrypt(zlib.compress(json.dumps(snapshot)))
+        tmp_filename = '%s.tmp-%d' % (self.filename, os.getpid())
+        with os.fdopen(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb') as handle:
+            handle.write(self.magic + a32_to_str(nonce) + data)
+        os.rename(tmp_filename, self.filename)
+
+    def delete(self):
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
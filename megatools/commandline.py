@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 
-from megaclient import MegaClient
+from megaindex import PathIndex
+from megajournal import TransferJournal
+from megatransfer import TransferScheduler
+from megautil import RateLimiter
+from megatools.daemon import MegaDaemon, request as daemon_request
 import sys
 import os
 import time
-import yaml
-import pyaml
 import shutil
+import stat
+import tempfile
 import getpass
+import hashlib
 import posixpath
 
 from supertools import superable
@@ -33,6 +38,8 @@ class MegaCommandLineClient(object) :
         self._seqno = None
 
         self._root = None
+        self._index = None
+        self._daemon = False
 
     def export_config(self) :
         if self._client is not None :
@@ -50,18 +57,78 @@ class MegaCommandLineClient(object) :
         self._master_key = config.get('master_key',None)
         self._seqno = config.get('seqno',None)
 
+    # the client and the stores pull in the crypto modules: they are imported
+    # by the commands that use them, not by a command forwarded to the daemon
+    def new_client(self, password) :
+        from megaclient import MegaClient
+        return MegaClient(self._email,password)
+
+    def get_store(self, filename='nodes') :
+        from megastore import NodeStore
+        return NodeStore(self._configuration_dirname, filename)
+
     def get_client(self) :
         if (self._client is None) and (self._sid != '') :
-            self._client = MegaClient(self._email,None)
+            self._client = self.new_client(None)
             self._client.sid = self._sid
             self._client.master_key = self._master_key
             self._client.seqno = self._seqno
         return self._client
 
+    def run(self, args) :
+        # hand the command line to a running daemon, unless it needs this terminal or streams stdin/stdout
+        if not self._daemon and len(args) > 1 and args[1] not in ('login', 'daemon') and '-' not in args[2:] :
+            # a daemon busy with a long transfer does not hold this command: it runs here
+            result = daemon_request(self.daemon_socket(), {'args' : args, 'cwd' : os.getcwd()}, busy_timeout=1)
+            if result is not None :
+                return result
+        return self.__super.run(args)
+
+    def daemon_socket(self) :
+        return os.path.join(self._configuration_dirname, 'daemon.sock')
+
+    def reset_session(self) :
+        self.load_config()
+        self._client = None
+        self._root = None
+        self._index = None
+
+    @CLRunner.command()
+    def daemon(self, args, kwargs) :
+        """keep the session and the tree in a background process (start, stop, status)"""
+        action = args[0] if len(args) > 0 else 'status'
+        if action == 'start' :
+            if daemon_request(self.daemon_socket(), {'ping' : True}) :
+                return
+            if not(os.path.exists(self._configuration_dirname)) :
+                os.makedirs(self._configuration_dirname,mode=0700)
+            if os.fork() :
+                self.status(_('daemon started'))
+                return
+            os.setsid()
+            null = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2) :
+                os.dup2(null, fd)
+            self._daemon = True
+            try :
+                MegaDaemon(self, self.daemon_socket(), os.path.join(self._configuration_dirname, self._configuration_filename)).serve()
+            finally :
+                os._exit(0)
+        elif action == 'stop' :
+            if daemon_request(self.daemon_socket(), {'stop' : True}) is None :
+                self.errorexit(_('No daemon running'))
+            self.status(_('daemon stopped'))
+        elif action == 'status' :
+            if daemon_request(self.daemon_socket(), {'ping' : True}) is None :
+                self.errorexit(_('No daemon running'))
+        else :
+            self.errorexit(_('Unknown daemon action [%s]') % (action,))
+
     @CLRunner.param(aliases=['d'])
     def debug(self, **kwargs) :
         '''Provide some debug informations'''
         self.help()
+        import yaml
         print yaml.dump(self._cl_params,default_flow_style=False)
 
     @CLRunner.param(name='help',aliases=['h'])
@@ -95,7 +162,7 @@ class MegaCommandLineClient(object) :
         if len(password) == 0 :
             self.errorexit(_('need a password to login'))
             
-        self._client = MegaClient(self._email,password)
+        self._client = self.new_client(password)
         try :
             self._client.login()
         except Exception :
@@ -103,6 +170,10 @@ class MegaCommandLineClient(object) :
         self._sid = self._client.sid
         self._master_key = self._client.master_key
         self.save_config()
+        # the tree and the index may belong to the account logged in before
+        self.invalidate_root()
+        self.get_store().delete()
+        self.del_stream('index')
 
         self.status('login success')
 
@@ -115,136 +186,391 @@ class MegaCommandLineClient(object) :
             self._seqno = None
             self.save_config()
             self._root = None
+            self._index = None
             self.del_stream('root')
+            self.get_store().delete()
+            self.del_stream('index')
         self.status('logged out')
 
     def get_root(self) :
+        # commands start from the snapshot left by the last load; only a missing snapshot goes to the network
         if self._root is not None :
             return self._root
         client = self.get_client()
         if client is None :
             self.errorexit(_('You must login first'))
-        files = client.getfiles()
-        root = {}
-        root['files'] = files
-        root['tree'] = {}
-        root['path'] = {}
-        treeitems = {}
-        for handle in files :
-            file = files[handle]
-            if handle not in treeitems :
-                treeitems[handle] = {}
-                treeitems[handle]['h'] = handle
-            treeitem = treeitems[handle]
-            if 'p' in file and file['p'] in files :
-                phandle = file['p']
-                if phandle not in treeitems :
-                    treeitems[phandle] = {}
-                    treeitems[phandle]['h'] = phandle
-                ptreeitem = treeitems[phandle]
-                if 'children' not in ptreeitem :
-                    ptreeitem['children'] = {}
-                ptreeitem['children'][handle] = treeitem
-            else :
-                root['tree'][handle] = treeitem
-        def updatepath(dictchildren, parentpath, level) :
-            for treeitem in dictchildren.values() :
-                node = files[treeitem['h']]
-                if not(node['a']) or type(node['a']) in (str,unicode) :
-                    node['a'] = { 'n' : '?(%s)' % (node['h'],) }
-                node['a']['path'] = posixpath.join(parentpath,node['a']['n'])
-                node['a']['level'] = level
-                root['path'][ node['a']['path'] ] = node['h']
-                if 'children' in treeitem :
-                    updatepath(treeitem['children'],node['a']['path'],level+1)
-        updatepath(root['tree'],'/',0)
-        self.save_stream('root',root)
+        from megasnapshot import TreeSnapshot
+        filename = os.path.join(self._configuration_dirname, 'root')
+        root = TreeSnapshot.load(filename, client.master_key)
+        if root is None :
+            files = client.loadfiles(self.get_store())
+            TreeSnapshot.write(filename, client.master_key, client.sn, files)
+            root = TreeSnapshot(filename, client.master_key)
         self._root = root
         return self._root
 
-    @CLRunner.command(params={
-        'filter' : {
-            'need_value' : True,
-            'aliases' : ['f'],
-            },
-        })
-    def find(self, args, kwargs) :
-        """list files on mega"""
+    def invalidate_root(self) :
+        # after a change made by this tool: the next command catches up from the node store
+        self._root = None
+        self._index = None
+        self.del_stream('root')
+
+    def get_index(self) :
+        if self._index is not None :
+            return self._index
         root = self.get_root()
-        for path in sorted(root['path']) :
-            node = root['files'][root['path'][path]]
-            if ('filter' not in kwargs) or (kwargs['filter'].lower() in node['a']['path'].lower()) :
-                self.status(":%s '%s'" % (node['h'],node['a']['path']))
+        client = self.get_client()
+        # the index is kept while the tree stays at the same sequence number
+        filename = os.path.join(self._configuration_dirname, 'index')
+        index = PathIndex.load(filename, client.master_key)
+        if index is None or root.sn is None or index.sn != root.sn :
+            index = PathIndex.build(root.entries(), root.sn)
+            index.write(filename, client.master_key)
+        self._index = index
+        return self._index
 
-    @CLRunner.command(params={
+    search_params = {
         'filter' : {
             'need_value' : True,
             'aliases' : ['f'],
             },
-        })
+        'glob' : {
+            'need_value' : True,
+            'aliases' : ['g'],
+            'doc' : 'shell pattern on the name',
+            },
+        'larger' : {
+            'need_value' : True,
+            'doc' : 'minimum size in bytes',
+            },
+        'smaller' : {
+            'need_value' : True,
+            'doc' : 'maximum size in bytes',
+            },
+        'newer' : {
+            'need_value' : True,
+            'doc' : 'minimum modification timestamp',
+            },
+        'older' : {
+            'need_value' : True,
+            'doc' : 'maximum modification timestamp',
+            },
+        }
+
+    def search(self, args, kwargs, filter_field) :
+        index = self.get_index()
+        text = lambda name : kwargs[name].decode('utf-8') if name in kwargs else None
+        number = lambda name : int(kwargs[name]) if name in kwargs else None
+        query = {
+            'path' : args[0].decode('utf-8') if len(args) > 0 else None,
+            filter_field : text('filter'),
+            'glob' : text('glob'),
+            'min_size' : number('larger'),
+            'max_size' : number('smaller'),
+            'newer' : number('newer'),
+            'older' : number('older'),
+            }
+        return index, index.query(**query)
+
+    @CLRunner.command(params=search_params)
+    def find(self, args, kwargs) :
+        """list files on mega, below an optional path"""
+        index, matches = self.search(args, kwargs, 'path_filter')
+        for i in matches :
+            self.status(":%s '%s'" % (index.handles[i],index.paths[i]))
+
+    @CLRunner.command(params=search_params)
     def show(self, args, kwargs) :
-        """list files on mega"""
-        root = self.get_root()
-        for path in sorted(root['path']) :
-            node = root['files'][root['path'][path]]
-            if ('filter' not in kwargs) or (kwargs['filter'].lower() in node['a']['n'].lower()) :
-                self.status(":%s %s'%s'" % (node['h'],'  '*node['a']['level'], node['a']['n']))
+        """list files on mega as a tree, below an optional path"""
+        index, matches = self.search(args, kwargs, 'name_filter')
+        for i in matches :
+            self.status(":%s %s'%s'" % (index.handles[i],'  '*index.level(i), index.name(i)))
     
     def findnode(self, root, arg, isfile=False, isdir=False) :
         if arg.startswith(':') :
             handle = arg[1:]
-            if handle not in root['files'] :
+            index = root.findhandle(handle)
+            if index < 0 :
                 self.errorexit(_('No node with handle [%s]')%(handle,))
-            node = root['files'][handle]
         else :
-            path = arg
-            if path not in root['path'] :
+            path = arg.decode('utf-8')
+            index = root.findpath(path)
+            if index < 0 :
                 self.errorexit(_('No node with path [%s]')%(path,))
-            node = root['files'][root['path'][path]]
-        if isfile and node['t']!=0 :
-            self.errorexit(_('Argument [%s] should be a file, but [%s] is not a file')%(arg, node['a']['n']))
-        if isdir and node['t'] not in (1,2,4) :
-            self.errorexit(_('Argument [%s] should be a folder,  but [%s] is not a folder')%(arg, node['a']['n']))
+        node = root.node(index)
+        if isfile and node.t!=0 :
+            self.errorexit(_('Argument [%s] should be a file, but [%s] is not a file')%(arg, node.name))
+        if isdir and node.t not in (1,2,4) :
+            self.errorexit(_('Argument [%s] should be a folder,  but [%s] is not a folder')%(arg, node.name))
         return node
 
-    @CLRunner.command()
+    transfer_params = {
+        'connections' : {
+            'need_value' : True,
+            'aliases' : ['c'],
+            'doc' : 'number of parallel connections',
+            },
+        'recursive' : {
+            'aliases' : ['r'],
+            'doc' : 'transfer a whole folder',
+            },
+        'transfers' : {
+            'need_value' : True,
+            'aliases' : ['t'],
+            'doc' : 'number of files transferred at once with --recursive',
+            },
+        'bandwidth' : {
+            'need_value' : True,
+            'aliases' : ['b'],
+            'doc' : 'bandwidth limit in KiB/s',
+            },
+        }
+
+    def transfer_options(self, client, kwargs) :
+        # the client outlives the command under the daemon: always replace the limit of the previous one
+        client.limiter = RateLimiter(int(kwargs['bandwidth'])*1024) if 'bandwidth' in kwargs else None
+        return int(kwargs['connections']) if 'connections' in kwargs else None
+
+    def get_scheduler(self, kwargs) :
+        return TransferScheduler(int(kwargs['transfers']) if 'transfers' in kwargs else 4)
+
+    def run_scheduler(self, scheduler) :
+        def done(transfer) :
+            if transfer.error is None :
+                self.status(_('Done [%s] (%s bytes)')%(transfer.name,transfer.size))
+            else :
+                self.error(_('Transfer of [%s] failed : %s')%(transfer.name,transfer.error))
+        success = scheduler.run(done)
+        self.status(_('%s files (%s bytes) transferred in %s seconds (%s KiB/s), %s failed')%(scheduler.completed, scheduler.transferred, int(scheduler.elapsed*10)/10., int(scheduler.throughput()*100/1024)/100., len(scheduler.failed)))
+        if not success :
+            self.errorexit(_('Some transfers failed'))
+
+    def subtree(self, root, node) :
+        # (relative path, node) of every node below a folder, parents first
+        index = self.get_index()
+        prefix = root.path(root.findhandle(node.h)).rstrip('/') + '/'
+        for i in index.query(path=prefix) :
+            yield index.paths[i][len(prefix):], root.node(root.findhandle(index.handles[i]))
+
+    def download(self, client, node, filename, connections) :
+        dirname, basename = os.path.split(filename)
+        # named after the node, so that an interrupted download is resumed by the next get
+        tmp_filename = os.path.join(dirname, '.mega-%s-%s' % (node.h,basename))
+        journal = TransferJournal(tmp_filename + '.journal')
+        if not client.downloadfile(node, tmp_filename, connections, journal) :
+            os.unlink(tmp_filename)
+            return False
+        shutil.move(tmp_filename, filename)
+        return True
+
+    def download_tree_file(self, client, node, filename, connections) :
+        if not self.download(client, node, filename, connections) :
+            raise IOError(_('Downloaded file does not match its MAC'))
+        # keep the remote timestamp, mirror uses it to skip up to date files
+        os.utime(filename, (node.ts, node.ts))
+
+    def local_name(self, name) :
+        # remote names come from other users too: never let one leave the destination folder
+        if name in ('', '.', '..') or '/' in name or os.sep in name or (os.altsep and os.altsep in name) or '\0' in name :
+            return None
+        return name
+
+    def local_path(self, dest, relpath) :
+        names = [self.local_name(name) for name in relpath.split('/')]
+        if None in names :
+            return None
+        filename = os.path.join(dest, *names)
+        real_dest = os.path.realpath(dest)
+        if not os.path.realpath(filename).startswith(real_dest.rstrip(os.sep) + os.sep) :
+            return None
+        return filename
+
+    def download_tree(self, root, node, dest, kwargs, mirror=False) :
+        client = self.get_client()
+        connections = self.transfer_options(client, kwargs)
+        scheduler = self.get_scheduler(kwargs)
+        if dest is None :
+            dest = self.local_name(node.name)
+            if dest is None :
+                self.errorexit(_('[%s] is not a valid local name, give a destination folder') % (node.name,))
+        if not os.path.isdir(dest) :
+            os.makedirs(dest)
+        skipped = 0
+        for relpath, child in self.subtree(root, node) :
+            filename = self.local_path(dest, relpath)
+            if filename is None :
+                self.error(_('Skipping [%s] : not a valid local path') % (relpath,))
+                skipped += 1
+                continue
+            if child.t != 0 :
+                if not os.path.isdir(filename) :
+                    os.makedirs(filename)
+            elif not(mirror and os.path.isfile(filename) and os.path.getsize(filename) == child.s and int(os.path.getmtime(filename)) == child.ts) :
+                scheduler.add(relpath, child.s, self.download_tree_file, client, child, filename, connections)
+        self.run_scheduler(scheduler)
+        if skipped :
+            self.errorexit(_('%s remote entries were skipped') % (skipped,))
+
+    def upload_journal(self, filename, handle) :
+        if isinstance(filename, unicode) :
+            filename = filename.encode('utf-8')
+        journal_name = hashlib.sha1('%s\0%s' % (os.path.abspath(filename), str(handle))).hexdigest()
+        return TransferJournal(os.path.join(self._configuration_dirname, 'transfers', journal_name))
+
+    def upload_tree_file(self, client, filename, handle, name, connections) :
+        res = client.uploadfile(filename, handle, name, connections, self.upload_journal(filename, handle))
+        if not isinstance(res, dict) :
+            raise IOError(_('Mega API error %s') % (res,))
+
+    def upload_tree(self, root, dirname, node, kwargs) :
+        client = self.get_client()
+        connections = self.transfer_options(client, kwargs)
+        scheduler = self.get_scheduler(kwargs)
+        # absolute, so that . or .. upload a folder named after the directory itself
+        dirname = os.path.abspath(dirname.decode(sys.getfilesystemencoding() or 'utf-8'))
+        basedir = os.path.dirname(dirname)
+        remotedir = root.path(root.findhandle(node.h))
+        folders = {'' : node.h}
+        # folders are created first, parents before children, existing ones are reused
+        for localdir, subdirs, filenames in os.walk(dirname) :
+            subdirs.sort()
+            relpath = os.path.relpath(localdir, basedir).replace(os.sep, '/')
+            path = posixpath.join(remotedir, relpath)
+            index = root.findpath(path)
+            if index >= 0 and root.node(index).t == 1 :
+                handle = root.node(index).h
+            else :
+                res = client.createfolder(folders[posixpath.dirname(relpath)], posixpath.basename(relpath))
+                if not isinstance(res, dict) :
+                    self.errorexit(_('Cannot create folder [%s] : Mega API error %s') % (path, res))
+                handle = res['f'][0]['h']
+            folders[relpath] = handle
+            for name in sorted(filenames) :
+                filename = os.path.join(localdir, name)
+                scheduler.add(posixpath.join(relpath, name), os.path.getsize(filename), self.upload_tree_file, client, filename, handle, name, connections)
+        self.invalidate_root()
+        self.run_scheduler(scheduler)
+
+    @CLRunner.command(params=transfer_params)
     def get(self, args, kwargs) :
-        """get a file"""
+        """get a file, to stdout with -, or a folder with --recursive"""
         root = self.get_root()
         if len(args) == 0 :
             self.errorexit(_('Need a file handle to download'))
+        if 'recursive' in kwargs :
+            node = self.findnode(root,args[0],isdir=True)
+            self.download_tree(root, node, args[1] if len(args) > 1 else None, kwargs)
+            return
         node = self.findnode(root,args[0],isfile=True)
-        filename = node['a']['n']
-        tmp_filename = '.mega-%s-%s' % (int(time.time()*1000),filename)
-        size = node['s']
+        client = self.get_client()
+        connections = self.transfer_options(client, kwargs)
+        if len(args) > 1 and args[1] == '-' :
+            # stdout carries the file, so no status messages
+            from megaclient import MegaError
+            try :
+                with client.openfile(node, connections) as stream :
+                    while True :
+                        data = stream.read(0x100000)
+                        if not data :
+                            break
+                        sys.stdout.write(data)
+                sys.stdout.flush()
+            except (IOError, MegaError), e :
+                self.errorexit(_('Download of [%s] failed : %s') % (node.name, e))
+            return
+        filename = self.local_name(node.name)
+        if filename is None :
+            self.errorexit(_('[%s] is not a valid local name') % (node.name,))
+        size = node.s
         self.status(_('Getting [%s] (%s bytes)')%(filename,size))
         
-        client = self.get_client()
         start_time = time.time()
-        client.downloadfile(node, tmp_filename)
-        shutil.move(tmp_filename, filename)
+        if not self.download(client, node, filename, connections) :
+            self.errorexit(_('Downloaded file [%s] does not match its MAC') % (filename,))
         stop_time = time.time()
         self.status(_('Transfert completed in %s seconds (%s KiB/s)')%(int((stop_time-start_time)*10)/10., int((size*100)/(1024*(stop_time-start_time)))/100. ))
 
+    @CLRunner.command(params=transfer_params)
+    def mirror(self, args, kwargs) :
+        """get the files of a folder that are missing or changed locally"""
+        root = self.get_root()
+        if len(args) == 0 :
+            self.errorexit(_('Need a folder handle to mirror'))
+        node = self.findnode(root,args[0],isdir=True)
+        self.download_tree(root, node, args[1] if len(args) > 1 else None, kwargs, mirror=True)
 
+    def upload_stdin(self, client, node, kwargs, connections) :
+        from megaclient import MegaError
+        if 'name' not in kwargs :
+            self.errorexit(_('Need a --name for the file read from stdin'))
+        infile = sys.stdin
+        if 'size' in kwargs :
+            size = int(kwargs['size'])
+        elif stat.S_ISREG(os.fstat(infile.fileno()).st_mode) :
+            size = os.fstat(infile.fileno()).st_size - infile.tell()
+        else :
+            # the upload url is requested with the size: a pipe without --size is spooled first
+            infile = tempfile.TemporaryFile()
+            shutil.copyfileobj(sys.stdin, infile)
+            size = infile.tell()
+            infile.seek(0)
+        self.status(_('Sending stdin as [%s] (%s bytes)')%(kwargs['name'],size))
+        start_time = time.time()
+        try :
+            stream = client.createfile(node.h, kwargs['name'].decode('utf-8'), size, connections)
+            while True :
+                data = infile.read(0x100000)
+                if not data :
+                    break
+                stream.write(data)
+            stream.close()
+        except (IOError, MegaError), e :
+            self.errorexit(_('Upload of [%s] failed : %s') % (kwargs['name'], e))
+        self.invalidate_root()
+        stop_time = time.time()
+        self.status(_('Transfert completed in %s seconds (%s KiB/s)')%(int((stop_time-start_time)*10)/10., int((size*100)/(1024*(stop_time-start_time)))/100. ))
 
-    @CLRunner.command()
+    put_params = dict(transfer_params, **{
+        'name' : {
+            'need_value' : True,
+            'aliases' : ['n'],
+            'doc' : 'name of the file read from stdin',
+            },
+        'size' : {
+            'need_value' : True,
+            'aliases' : ['s'],
+            'doc' : 'size of the file read from stdin, when it is a pipe',
+            },
+        })
+
+    @CLRunner.command(params=put_params)
     def put(self, args, kwargs) :
-        """put a file"""
+        """put a file, stdin with -, or a folder with --recursive"""
         root = self.get_root()
         if len(args) < 2 :
             self.errorexit(_('Need a file to upload and a directory handle where to upload'))
         filename = args[0]
-        if not(os.path.exists(filename)) :
+        if filename != '-' and not(os.path.exists(filename)) :
             self.errorexit(_("File [%s] doesn't exists") % (filename,))
         node = self.findnode(root,args[1],isdir=True)
+        if filename == '-' :
+            client = self.get_client()
+            self.upload_stdin(client, node, kwargs, self.transfer_options(client, kwargs))
+            return
+        if 'recursive' in kwargs :
+            if not(os.path.isdir(filename)) :
+                self.errorexit(_("[%s] is not a directory") % (filename,))
+            self.upload_tree(root, filename, node, kwargs)
+            return
         
         client = self.get_client()
         dirname, basename = os.path.split(filename)
         size = os.stat(filename).st_size
         self.status(_('Sending [%s] (%s bytes)')%(filename,size))
         start_time = time.time()
-        client.uploadfile(filename, node['h'], basename)
+        connections = self.transfer_options(client, kwargs)
+        client.uploadfile(filename, node.h, basename, connections, self.upload_journal(filename, node.h))
+        self.invalidate_root()
         stop_time = time.time()
         self.status(_('Transfert completed in %s seconds (%s KiB/s)')%(int((stop_time-start_time)*10)/10., int((size*100)/(1024*(stop_time-start_time)))/100. ))
 
@@ -253,9 +579,10 @@ class MegaCommandLineClient(object) :
     @CLRunner.command()
     def reload(self, args, kwargs) :
         """reload the filesystem"""
-        self._root = None
-        self.del_stream('root')
-        self.get_root()
+        self.invalidate_root()
+        self.get_store().delete()
+        self.del_stream('index')
+        self.get_index()
 
 
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import json
+import os
+import socket
+import struct
+import sys
+import traceback
+
+# a reply is a stream of frames: kind ('o' stdout, 'e' stderr, 'x' exit status) and a length prefixed payload
+FRAME = struct.Struct('>cI')
+# the empty frame the daemon sends when it takes a connection, before the request is sent
+ACCEPTED = FRAME.pack('a', 0)
+
+
+class FrameWriter(object) :
+    """File-like object sending what is written as frames of one kind"""
+    def __init__(self, connection, kind) :
+        self._connection = connection
+        self._kind = kind
+
+    def write(self, data) :
+        if isinstance(data, unicode) :
+            data = data.encode('utf-8')
+        if data :
+            self._connection.sendall(FRAME.pack(self._kind, len(data)) + data)
+
+    def flush(self) :
+        pass
+
+
+def recvall(connection, size) :
+    data = []
+    while size > 0 :
+        chunk = connection.recv(size)
+        if not chunk :
+            raise socket.error('connection closed by the daemon')
+        data.append(chunk)
+        size -= len(chunk)
+    return ''.join(data)
+
+
+def request(socket_path, message, busy_timeout=None) :
+    '''Send a request to the daemon and copy its output; returns the exit status, or None when no daemon
+    answers, or when it does not take the request within busy_timeout seconds because it runs another one'''
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try :
+        try :
+            connection.connect(socket_path)
+            connection.settimeout(busy_timeout)
+            if recvall(connection, FRAME.size) != ACCEPTED :
+                return None
+        except socket.error :
+            # socket.timeout included: the request is not sent yet, so the daemon will not run it
+            return None
+        connection.settimeout(None)
+        connection.sendall(json.dumps(message) + '\n')
+        while True :
+            kind, size = FRAME.unpack(recvall(connection, FRAME.size))
+            data = recvall(connection, size)
+            if kind == 'x' :
+                return data == '1'
+            stream = sys.stdout if kind == 'o' else sys.stderr
+            stream.write(data)
+            stream.flush()
+    finally :
+        connection.close()
+
+
+class MegaDaemon(object) :
+    """Serves command lines on a unix socket with one long lived runner, so
+    that the session, the tree and the connection pool stay warm"""
+    def __init__(self, runner, socket_path, config_path) :
+        self._runner = runner
+        self._socket_path = socket_path
+        self._config_path = config_path
+        self._config_mtime = self.config_mtime()
+
+    def config_mtime(self) :
+        try :
+            return os.path.getmtime(self._config_path)
+        except OSError :
+            return None
+
+    def serve(self) :
+        if os.path.exists(self._socket_path) :
+            os.unlink(self._socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0077)
+        try :
+            listener.bind(self._socket_path)
+        finally :
+            os.umask(old_umask)
+        listener.listen(16)
+        try :
+            running = True
+            # one command at a time: they share the runner state
+            while running :
+                connection, _ = listener.accept()
+                try :
+                    connection.sendall(ACCEPTED)
+                    running = self.handle(connection)
+                except socket.error :
+                    pass
+                finally :
+                    connection.close()
+        finally :
+            listener.close()
+            os.unlink(self._socket_path)
+
+    def handle(self, connection) :
+        reader = connection.makefile('rb')
+        line = reader.readline()
+        reader.close()
+        if not line :
+            # the client gave up waiting while another command ran, and runs this one itself
+            return True
+        message = json.loads(line)
+        status = FrameWriter(connection, 'x')
+        if message.get('stop') :
+            status.write('1')
+            return False
+        if message.get('ping') :
+            FrameWriter(connection, 'o').write('daemon running (pid %d)\n' % (os.getpid(),))
+            status.write('1')
+            return True
+        if self.config_mtime() != self._config_mtime :
+            # login or logout from outside the daemon
+            self._runner.reset_session()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = FrameWriter(connection, 'o')
+        sys.stderr = FrameWriter(connection, 'e')
+        try :
+            os.chdir(message['cwd'])
+            result = self._runner.run([arg.encode('utf-8') for arg in message['args']])
+        except Exception :
+            sys.stderr.write(traceback.format_exc())
+            result = False
+        finally :
+            sys.stdout, sys.stderr = stdout, stderr
+        self._config_mtime = self.config_mtime()
+        status.write('1' if result else '0')
+        return True
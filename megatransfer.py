@@ -0,0 +1,68 @@
+import Queue
+import threading
+import time
+
+
+class Transfer(object):
+    def __init__(self, name, size, func, args):
+        self.name = name
+        self.size = size
+        self.func = func
+        self.args = args
+        self.error = None
+
+
+class TransferScheduler(object):
+    """Runs many file transfers at once, smallest first, and totals their
+    throughput; the bandwidth limit is the client's RateLimiter."""
+
+    def __init__(self, transfers=4):
+        self.transfers = transfers
+        self.pending = []
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.failed = []
+        self.transferred = 0
+        self.elapsed = 0.
+
+    def add(self, name, size, func, *args):
+        self.pending.append(Transfer(name, size, func, args))
+
+    def run(self, callback=None):
+        # small files first: they finish early and are not held up behind large ones
+        queue = Queue.Queue()
+        for transfer in sorted(self.pending, key=lambda transfer: transfer.size):
+            queue.put(transfer)
+        self.pending = []
+
+        def worker():
+            while True:
+                try:
+                    transfer = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    transfer.func(*transfer.args)
+                except Exception, e:
+                    transfer.error = e
+                with self.lock:
+                    if transfer.error is None:
+                        self.completed += 1
+                        self.transferred += transfer.size
+                    else:
+                        self.failed.append(transfer)
+                    if callback is not None:
+                        callback(transfer)
+
+        start_time = time.time()
+        threads = [threading.Thread(target=worker) for _ in xrange(max(1, min(self.transfers, queue.qsize())))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed += time.time() - start_time
+        return not self.failed
+
+    def throughput(self):
+        return self.transferred / self.elapsed if self.elapsed else 0.
@@ -0,0 +1,145 @@
+import Queue
+import os
+import threading
+import time
+
+
+class UploadJob(object):
+    def __init__(self, key, src_path, target, filename, size, callback):
+        self.key = key
+        self.src_path = src_path
+        self.target = target
+        self.filename = filename
+        self.size = size
+        self.callback = callback
+        self.done = threading.Event()
+        self.error = None
+        self.superseded = False
+
+
+class UploadQueue(object):
+    """Uploads spooled files in the background with a bounded number of
+    workers and a bounded amount of spooled data."""
+
+    def __init__(self, client, workers=2, spool_size=1 << 30):
+        self.client = client
+        self.spool_size = spool_size
+        self.queue = Queue.Queue()
+        self.jobs = {}
+        # failed jobs by key, with their spooled file kept until a retry succeeds or a newer job replaces them
+        self.failures = {}
+        self.lock = threading.Condition()
+        self.spooled = 0
+        self.running = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.uploaded_bytes = 0
+        self.upload_time = 0.
+        for _ in xrange(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, key, src_path, target, filename, callback):
+        size = os.path.getsize(src_path)
+        job = UploadJob(key, src_path, target, filename, size, callback)
+        with self.lock:
+            # block the caller while the spool is full, but always accept a job on an empty spool
+            while self.spooled and self.spooled + size > self.spool_size:
+                self.lock.wait()
+            self.spooled += size
+            self.jobs.setdefault(key, []).append(job)
+            failed = self.failures.pop(key, None)
+        if failed is not None:
+            os.unlink(failed.src_path)
+        self.queue.put(job)
+        return job
+
+    def retry(self, key):
+        with self.lock:
+            job = self.failures.pop(key, None)
+            if job is None:
+                return
+            job.done.clear()
+            job.error = None
+            self.spooled += job.size
+            self.jobs.setdefault(key, []).append(job)
+        self.queue.put(job)
+
+    def pending(self, key):
+        # the latest job of key still waiting for its upload or kept after a failure, else None
+        with self.lock:
+            jobs = self.jobs.get(key)
+            return jobs[-1] if jobs else self.failures.get(key)
+
+    def wait(self, key):
+        # errors of the last upload of key; a failure is reported until it is retried or replaced
+        with self.lock:
+            jobs = list(self.jobs.get(key, []))
+        for job in jobs:
+            job.done.wait()
+        with self.lock:
+            failed = self.failures.get(key)
+        return [failed.error] if failed is not None else []
+
+    def drain(self, retry=False):
+        # waits for every queued job; with retry, failed jobs get one more attempt. Returns the failures left
+        if retry:
+            with self.lock:
+                keys = list(self.failures)
+            for key in keys:
+                self.retry(key)
+        with self.lock:
+            while self.jobs:
+                self.lock.wait()
+            return dict(self.failures)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                self.running += 1
+            start_time = time.time()
+            try:
+                job.callback(self.client.uploadfile(job.src_path, job.target, job.filename))
+            except Exception, e:
+                job.error = e
+            else:
+                os.unlink(job.src_path)
+            with self.lock:
+                self.running -= 1
+                self.spooled -= job.size
+                if job.error is None:
+                    self.uploaded += 1
+                    self.uploaded_bytes += job.size
+                    self.upload_time += time.time() - start_time
+                else:
+                    self.failed += 1
+                jobs = self.jobs[job.key]
+                position = jobs.index(job)
+                if job.error is None:
+                    for older in jobs[:position]:
+                        older.superseded = True
+                elif job.superseded or position < len(jobs) - 1:
+                    # a newer upload of the same key replaces this one
+                    os.unlink(job.src_path)
+                else:
+                    self.failures[job.key] = job
+                del jobs[position]
+                if not jobs:
+                    del self.jobs[job.key]
+                self.lock.notify_all()
+            job.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queued': self.queue.qsize(),
+                'running': self.running,
+                'spooled': self.spooled,
+                'uploaded': self.uploaded,
+                'failed': self.failed,
+                'failed_pending': len(self.failures),
+                'uploaded_bytes': self.uploaded_bytes,
+                'throughput': int(self.uploaded_bytes / self.upload_time) if self.upload_time else 0,
+                }
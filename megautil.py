@@ -1,6 +1,10 @@
+import Queue
 import base64
 import binascii
 import struct
+import sys
+import threading
+import time
 
 
 def base64urldecode(data):
@@ -60,3 +64,53 @@ def get_chunks(size):
       del chunks[pp]
 
     return chunks
+
+
+def parallel_map(func, items, workers):
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        while not errors:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for _ in xrange(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+class RateLimiter(object):
+    """Token bucket in bytes per second, shared by concurrent transfers"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        # take the tokens at once and sleep off the debt, so a chunk larger than the bucket still goes through
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - amount
+            self.last = now
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
@@ -0,0 +1,61 @@
+from megatools.daemon import MegaDaemon, request
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+
+class Runner(object):
+    def __init__(self):
+        self.commands = []
+        self.release = threading.Event()
+
+    def run(self, args):
+        self.commands.append(args)
+        if args[1] == 'slow':
+            self.release.wait()
+        return True
+
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.dirname, 'daemon.sock')
+        self.runner = Runner()
+        self.daemon = threading.Thread(target=MegaDaemon(self.runner, self.socket_path, os.path.join(self.dirname, 'config')).serve)
+        self.daemon.start()
+        while not os.path.exists(self.socket_path):
+            self.daemon.join(0.01)
+
+    def tearDown(self):
+        self.runner.release.set()
+        request(self.socket_path, {'stop': True})
+        self.daemon.join()
+        shutil.rmtree(self.dirname)
+
+    def command(self, name, busy_timeout=None):
+        return request(self.socket_path, {'args': ['mega', name], 'cwd': os.getcwd()}, busy_timeout)
+
+    def test_command(self):
+        self.assertTrue(self.command('find', busy_timeout=1))
+        self.assertEqual(self.runner.commands, [['mega', 'find']])
+
+    def test_busy(self):
+        slow = threading.Thread(target=self.command, args=('slow',))
+        slow.start()
+        while not self.runner.commands:
+            slow.join(0.01)
+        # the daemon is running another command: the caller runs this one itself
+        self.assertIsNone(self.command('find', busy_timeout=0.2))
+        self.runner.release.set()
+        slow.join()
+        self.assertTrue(self.command('show', busy_timeout=1))
+        self.assertEqual(self.runner.commands, [['mega', 'slow'], ['mega', 'show']])
+
+    def test_no_daemon(self):
+        self.assertIsNone(request(os.path.join(self.dirname, 'missing.sock'), {'ping': True}, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+from megacrypto import aes_cbc_encrypt_a32, chunk_mac, condense_macs
+from megautil import get_chunks, str_to_a32
+import random
+import unittest
+
+
+def reference_chunk_mac(chunk, key, iv):
+    # the original per-block loop that chunk_mac replaced
+    mac = [iv[0], iv[1], iv[0], iv[1]]
+    for i in xrange(0, len(chunk), 16):
+        block = chunk[i:i + 16]
+        if len(block) % 16:
+            block += '\0' * (16 - len(block) % 16)
+        block = str_to_a32(block)
+        mac = [mac[0] ^ block[0], mac[1] ^ block[1], mac[2] ^ block[2], mac[3] ^ block[3]]
+        mac = aes_cbc_encrypt_a32(mac, key)
+    return tuple(mac)
+
+
+def reference_file_mac(data, key, iv):
+    file_mac = [0, 0, 0, 0]
+    for chunk_start, chunk_size in sorted(get_chunks(len(data)).items()):
+        mac = reference_chunk_mac(data[chunk_start:chunk_start + chunk_size], key, iv)
+        file_mac = [file_mac[0] ^ mac[0], file_mac[1] ^ mac[1], file_mac[2] ^ mac[2], file_mac[3] ^ mac[3]]
+        file_mac = aes_cbc_encrypt_a32(file_mac, key)
+    return (file_mac[0] ^ file_mac[1], file_mac[2] ^ file_mac[3])
+
+
+class ChunkMacTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(5)
+        self.key = tuple(self.random.randint(0, 0xffffffff) for _ in xrange(4))
+        self.iv = (self.random.randint(0, 0xffffffff), self.random.randint(0, 0xffffffff), 0, 0)
+
+    def data(self, size):
+        return ('%0*x' % (size * 2, self.random.getrandbits(size * 8))).decode('hex') if size else ''
+
+    def assertSameMac(self, data):
+        self.assertEqual(tuple(chunk_mac(data, self.key, self.iv)), reference_chunk_mac(data, self.key, self.iv))
+
+    def test_empty(self):
+        self.assertSameMac('')
+
+    def test_partial_block(self):
+        for size in (1, 5, 15):
+            self.assertSameMac(self.data(size))
+
+    def test_whole_blocks(self):
+        for size in (16, 32, 0x20000):
+            self.assertSameMac(self.data(size))
+
+    def test_partial_last_block(self):
+        self.assertSameMac(self.data(0x20000 - 7))
+
+    def test_file_mac(self):
+        # several of the growing chunks, the last one ending in a partial block
+        for size in (0, 5, 0x20000, 0x20000 * 3 + 1, 0x20000 * 11 + 9):
+            data = self.data(size)
+            macs = [chunk_mac(data[chunk_start:chunk_start + chunk_size], self.key, self.iv) for chunk_start, chunk_size in sorted(get_chunks(size).items())]
+            self.assertEqual(condense_macs(macs, self.key), reference_file_mac(data, self.key, self.iv))
+
+
+if __name__ == '__main__':
+    unittest.main()
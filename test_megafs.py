@@ -0,0 +1,292 @@
+from megacrypto import encrypt_key, enc_attr
+from megautil import a32_to_base64, base64urlencode
+import errno
+import json
+import os
+import random
+import sys
+import threading
+import time
+import types
+import unittest
+
+try:
+    import fuse
+except ImportError:
+    # only the pieces MegaFS uses outside of a mount
+    fuse = sys.modules['fuse'] = types.ModuleType('fuse')
+    fuse.Fuse = type('Fuse', (object,), {'__init__': lambda self, *args, **kw: None})
+    fuse.Stat = type('Stat', (object,), {})
+    fuse.Direntry = type('Direntry', (object,), {'__init__': lambda self, name, **kw: setattr(self, 'name', name)})
+
+from megaclient import MegaClient
+from megacache import BlockCache
+from megafs import MegaFS, MegaReader
+from megaupload import UploadQueue
+
+
+class FakeAPI(object):
+    """Answers the cs requests of a MegaClient with a tree of encrypted nodes"""
+
+    def __init__(self, master_key, folders=20):
+        self.master_key = master_key
+        self.lock = threading.Lock()
+        self.ids = []
+        self.deleted = []
+        self.keys = {}
+        # recorded answers of the sc channel, oldest first
+        self.sc = []
+        self.nodes = [{'h': 'ROOT', 'p': '', 't': 2, 'u': 'me', 'a': '', 'k': '', 'ts': 1}]
+        for i in xrange(folders):
+            self.nodes.append(self.node('d%d' % (i,), 'ROOT', 1, 'dir%d' % (i,)))
+
+    def node(self, h, p, t, name):
+        key = tuple(random.getrandbits(32) for _ in xrange(4))
+        if t == 0:
+            # file keys are stored xored with the iv and meta mac that follow them
+            extra = tuple(random.getrandbits(32) for _ in xrange(4))
+            node_key = tuple(key[i] ^ extra[i] for i in xrange(4)) + extra
+        else:
+            node_key = key
+        self.keys[h] = key
+        return {'h': h, 'p': p, 't': t, 'u': 'me', 'ts': 1, 's': 1, 'k': 'me:' + a32_to_base64(encrypt_key(node_key, self.master_key)), 'a': base64urlencode(enc_attr({'n': name}, key))}
+
+    def rename(self, h, name):
+        return {'a': 'u', 'n': h, 'at': base64urlencode(enc_attr({'n': name}, self.keys[h])), 'ts': 2}
+
+    def post(self, url, data):
+        if '/sc?' in url:
+            return json.dumps(self.sc.pop(0))
+        with self.lock:
+            self.ids.append(url.split('id=')[1].split('&')[0])
+        results = []
+        for req in json.loads(data):
+            if req.get('a') == 'f':
+                results.append({'f': [dict(node) for node in self.nodes], 'ok': [], 's': [], 'sn': 'SN'})
+            elif req.get('a') == 'd':
+                with self.lock:
+                    self.deleted.append(req['n'])
+                results.append(0)
+            else:
+                results.append(0)
+        return json.dumps(results)
+
+
+class MegaFSTest(unittest.TestCase):
+    def setUp(self):
+        self.client = MegaClient('user@example.com', 'password')
+        self.client.master_key = (1, 2, 3, 4)
+        self.client.sid = 'SID'
+        self.api = FakeAPI(self.client.master_key)
+        self.client.post = self.api.post
+        self.fs = MegaFS(self.client)
+        self.fs.nodes = self.client.getfiles()
+        for file_h in self.fs.nodes:
+            self.fs.addnode(file_h)
+
+    def test_tree(self):
+        self.assertEqual(sorted(name for name in self.fs.files['/Cloud Drive'].children), sorted('dir%d' % (i,) for i in xrange(20)))
+        self.assertEqual(self.fs.getattr('/Cloud Drive/dir3').st_nlink, 2)
+
+    def test_concurrent_changes(self):
+        # readers list, stat and create entries while action packets add and delete nodes
+        errors = []
+        stop = threading.Event()
+
+        def mutate():
+            i = 0
+            while not stop.is_set():
+                i += 1
+                packets = [{'a': 't', 't': {'f': [self.api.node('f%d' % (i,), 'd%d' % (random.randint(0, 19),), 0, 'file%d' % (i,))]}}]
+                if i > 5:
+                    packets.append({'a': 'd', 'n': 'f%d' % (random.randint(1, i - 1),)})
+                try:
+                    with self.fs.lock:
+                        self.fs.applychanges(self.client.applypackets(self.fs.nodes, packets))
+                except Exception, e:
+                    errors.append(e)
+
+        def read():
+            while not stop.is_set():
+                dirname = '/Cloud Drive/dir%d' % (random.randint(0, 19),)
+                try:
+                    for dirent in self.fs.readdir(dirname, 0):
+                        if dirent.name not in ('.', '..'):
+                            self.fs.getattr(dirname + '/' + dirent.name)
+                    self.fs.mknod(dirname + '/local%d' % (random.randint(0, 1000),), 0, 0)
+                except Exception, e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=mutate)] + [threading.Thread(target=read) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(2)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for file_h in self.fs.nodes:
+            path = self.fs.hash2path[file_h]
+            self.assertIs(self.fs.files[path], self.fs.nodes[file_h])
+            dirname, basename = path.rsplit('/', 1)
+            self.assertIn(basename, self.fs.files[dirname or '/'].children)
+
+    def replay(self, *responses):
+        # the recorded sc answers go through the same steps as MegaFS.pollupdates
+        self.api.sc.extend(responses)
+        packets, sn, wait_url = self.client.getupdates(self.client.sn)
+        with self.fs.lock:
+            self.fs.applychanges(self.client.applypackets(self.fs.nodes, packets))
+        self.client.sn = sn
+        return packets
+
+    def test_action_packets(self):
+        api = self.api
+        self.replay(
+            {'a': [{'a': 't', 't': {'f': [api.node('s1', 'd1', 1, 'sub'), api.node('f1', 's1', 0, 'a.txt'), api.node('f2', 's1', 0, 'b.txt')]}}], 'sn': 'SN1'},
+            {'a': [{'a': 't', 't': {'f': [api.node('f3', 'd2', 0, 'c.txt')]}}], 'sn': 'SN2', 'w': 'http://wait'})
+        self.assertEqual(self.client.sn, 'SN2')
+        self.assertEqual(self.fs.path2hash['/Cloud Drive/dir1/sub/b.txt'], 'f2')
+        self.assertEqual(self.fs.path2hash['/Cloud Drive/dir2/c.txt'], 'f3')
+
+        # rename a folder: its subtree follows
+        self.replay({'a': [api.rename('s1', 'renamed')], 'sn': 'SN3', 'w': 'http://wait'})
+        self.assertEqual(self.fs.path2hash['/Cloud Drive/dir1/renamed/a.txt'], 'f1')
+        self.assertNotIn('/Cloud Drive/dir1/sub', self.fs.files)
+
+        # move: a flagged delete, then the node under its new parent
+        self.replay({'a': [{'a': 'd', 'n': 's1', 'm': 1}, {'a': 't', 't': {'f': [api.node('s1', 'd3', 1, 'renamed')]}}], 'sn': 'SN4', 'w': 'http://wait'})
+        self.assertEqual(self.fs.path2hash['/Cloud Drive/dir3/renamed/b.txt'], 'f2')
+        self.assertNotIn('renamed', self.fs.files['/Cloud Drive/dir1'].children)
+
+        # deleting a folder removes its subtree
+        self.replay({'a': [{'a': 'd', 'n': 's1'}], 'sn': 'SN5', 'w': 'http://wait'})
+        for handle in ('s1', 'f1', 'f2'):
+            self.assertNotIn(handle, self.fs.nodes)
+            self.assertNotIn(handle, self.fs.hash2path)
+        self.assertNotIn('/Cloud Drive/dir3/renamed/b.txt', self.fs.files)
+        self.assertEqual(self.fs.path2hash['/Cloud Drive/dir2/c.txt'], 'f3')
+
+    def test_foreign_parent(self):
+        # the root of an incoming share has a parent outside of the tree
+        packets = self.replay({'a': [{'a': 't', 't': {'f': [self.api.node('sh', 'FOREIGN', 1, 'shared'), self.api.node('sf', 'sh', 0, 'file')]}}], 'sn': 'SN1', 'w': 'http://wait'})
+        self.assertEqual(self.fs.path2hash['/shared/file'], 'sf')
+        # packets are left as received, so a failed poll can apply them again
+        with self.fs.lock:
+            self.fs.applychanges(self.client.applypackets(self.fs.nodes, packets))
+        self.assertEqual(self.fs.path2hash['/shared/file'], 'sf')
+
+    def fakeuploads(self):
+        uploads = []
+
+        def uploadfile(src_path, target, filename, connections=None, journal=None):
+            with open(src_path, 'rb') as handle:
+                uploads.append(handle.read())
+            return {'f': [self.api.node('N%d' % (len(uploads),), target, 0, filename)]}
+        self.client.uploadfile = uploadfile
+        return uploads
+
+    def writefsyncwrite(self, path):
+        self.fs.mknod(path, 0, 0)
+        fh = self.fs.open(path, os.O_WRONLY)
+        self.fs.write(path, 'first', 0, fh)
+        self.assertEqual(self.fs.fsync(path, False, fh), None)
+        self.fs.write(path, ' second', 5, fh)
+        self.assertEqual(self.fs.flush(path, fh), None)
+        self.fs.release(path, os.O_WRONLY, fh)
+
+    def assertReplaced(self, path, uploads):
+        # the node of the fsync is deleted once the complete file is uploaded
+        self.assertEqual(uploads, ['first', 'first second'])
+        self.assertEqual(self.api.deleted, ['N1'])
+        self.assertEqual(self.fs.path2hash[path], 'N2')
+        self.assertEqual(self.fs.hash2path.get('N1'), None)
+        self.assertNotIn('N1', self.fs.nodes)
+
+    def test_truncated_block(self):
+        self.api.nodes.append(self.api.node('f1', 'd1', 0, 'f.bin'))
+        file = self.client.getfiles()['f1']
+        file.s = 0x30000
+        responses = ['x' * 0x1000, 'x' * 0x20000, 'x' * 0x10000]
+        self.client.getdownloadurl = lambda file: 'http://dl'
+        self.client.transport.request = lambda method, url, headers: responses.pop(0)
+        self.client.retry.base_delay = 0
+        reader = MegaReader(self.client, BlockCache(memory_size=1 << 20), file)
+        self.assertEqual(len(reader.read(0x30000, 0)), 0x30000)
+        self.assertEqual(responses, [])
+        self.assertEqual(self.client.retry.metrics.stats()['read.retries'], 1)
+
+    def test_fsync_then_write(self):
+        uploads = self.fakeuploads()
+        path = '/Cloud Drive/dir1/new.txt'
+        self.writefsyncwrite(path)
+        self.assertReplaced(path, uploads)
+
+    def test_fsync_then_write_writeback(self):
+        uploads = self.fakeuploads()
+        self.fs.uploads = UploadQueue(self.client, 1)
+        path = '/Cloud Drive/dir1/new.txt'
+        self.writefsyncwrite(path)
+        self.fs.uploads.drain()
+        self.assertReplaced(path, uploads)
+
+    def test_pending_upload(self):
+        # until the background upload completes, the closed file is served from its spool
+        uploads = self.fakeuploads()
+        fakeupload = self.client.uploadfile
+        unblock = threading.Event()
+
+        def uploadfile(*args):
+            unblock.wait()
+            return fakeupload(*args)
+        self.client.uploadfile = uploadfile
+        self.fs.uploads = UploadQueue(self.client, 1)
+        path = '/Cloud Drive/dir1/new.txt'
+        self.fs.mknod(path, 0, 0)
+        fh = self.fs.open(path, os.O_WRONLY)
+        self.fs.write(path, 'content', 0, fh)
+        self.assertEqual(self.fs.open(path, os.O_WRONLY), -errno.EBUSY)
+        self.fs.release(path, os.O_WRONLY, fh)
+        self.assertEqual(self.fs.getattr(path).st_size, 7)
+        reader = self.fs.open(path, os.O_RDONLY)
+        self.assertEqual(self.fs.read(path, 4, 3, reader), 'tent')
+        self.fs.release(path, os.O_RDONLY, reader)
+        self.assertEqual(self.fs.open(path, os.O_WRONLY), -errno.EBUSY)
+        unblock.set()
+        self.assertEqual(self.fs.uploads.drain(), {})
+        self.assertEqual(uploads, ['content'])
+        self.assertEqual(self.fs.path2hash[path], 'N1')
+
+    def test_failed_upload_at_drain(self):
+        attempts = []
+
+        def uploadfile(*args):
+            attempts.append(args)
+            raise IOError('refused')
+        self.client.uploadfile = uploadfile
+        self.fs.uploads = UploadQueue(self.client, 1)
+        path = '/Cloud Drive/dir1/new.txt'
+        self.fs.mknod(path, 0, 0)
+        fh = self.fs.open(path, os.O_WRONLY)
+        self.fs.write(path, 'content', 0, fh)
+        self.fs.release(path, os.O_WRONLY, fh)
+        self.assertEqual(self.fs.flush(path), -errno.EIO)
+        failures = self.fs.uploads.drain(retry=True)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(failures.keys(), [path])
+        self.assertTrue(os.path.exists(failures[path].src_path))
+        os.unlink(failures[path].src_path)
+
+    def test_unique_request_ids(self):
+        del self.api.ids[:]
+        threads = [threading.Thread(target=lambda: [self.client.api_req({'a': 'x'}) for _ in xrange(200)]) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.api.ids), 1600)
+        self.assertEqual(len(set(self.api.ids)), 1600)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from megaindex import PathIndex
+import fnmatch
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+WORDS = [u'Photo', u'doc', u'\xc9t\xe9', u'x y', u'a.b', u'Mp3']
+MASTER_KEY = (1, 2, 3, 4)
+
+
+class PathIndexTest(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(3)
+        paths = set()
+        while len(paths) < 2000:
+            paths.add(u'/Cloud Drive/' + u'/'.join(generator.choice(WORDS) + unicode(generator.randint(0, 9)) for _ in xrange(generator.randint(1, 3))))
+        self.entries = sorted((path, 'h%d' % (i,), generator.randint(0, 1000), generator.randint(0, 1000)) for i, path in enumerate(paths))
+        self.index = PathIndex.build(self.entries, 'sn1')
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def assertQuery(self, index, matches, **query):
+        self.assertEqual([(index.paths[i], index.handles[i]) for i in index.query(**query)], [entry[:2] for entry in self.entries if matches(entry)])
+
+    def assertQueries(self, index):
+        name = lambda entry: entry[0][entry[0].rfind('/') + 1:].lower()
+        below = self.entries[100][0].rsplit(u'/', 1)[0]
+        self.assertQuery(index, lambda entry: True)
+        self.assertQuery(index, lambda entry: u'\xe9t\xe91' in entry[0].lower(), path_filter=u'\xc9T\xc91')
+        self.assertQuery(index, lambda entry: u'mp3' in name(entry), name_filter=u'MP3')
+        self.assertQuery(index, lambda entry: fnmatch.fnmatchcase(name(entry), u'photo?'), glob=u'Photo?')
+        self.assertQuery(index, lambda entry: entry[0].startswith(below + u'/') and 100 <= entry[2] <= 500 and entry[3] >= 200, path=below, min_size=100, max_size=500, newer=200)
+
+    def test_query(self):
+        self.assertQueries(self.index)
+
+    def test_load(self):
+        self.index.write(self.filename, MASTER_KEY)
+        index = PathIndex.load(self.filename, MASTER_KEY)
+        self.assertEqual(index.sn, 'sn1')
+        self.assertEqual(list(index.sizes), [entry[2] for entry in self.entries])
+        self.assertQueries(index)
+
+    def test_load_other_account(self):
+        self.index.write(self.filename, MASTER_KEY)
+        self.assertIsNone(PathIndex.load(self.filename, (1, 2, 3, 5)))
+        self.assertIsNone(PathIndex.load(os.path.join(self.dirname, 'missing'), MASTER_KEY))
+
+
+if __name__ == '__main__':
+    unittest.main()